@@ -2,17 +2,21 @@ from datetime import datetime
 import gc
 import warnings
 
-from KDEpy import FFTKDE
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
 from scipy._lib._util import check_random_state
 from scipy.optimize import minimize, basinhopping, least_squares
+from scipy.spatial.transform import Rotation
 from scipy.stats import entropy
-from scipy.spatial.ckdtree import cKDTree
 
 from calibration.img_edge_detector import ImgEdgeDetector
 from calibration.pc_edge_detector import PcEdgeDetector
 from calibration.utils.data_utils import *
 from calibration.utils.img_utils import *
+from calibration.utils.kernel_utils import *
 from calibration.utils.pc_utils import *
 
 
@@ -56,6 +60,9 @@ class CameraLidarCalibrator:
         self.num_frames = len(self.img_detector.imgs)
         print('Images and pointclouds loaded.')
 
+        # Stacked point clouds and projection buffers
+        self.allocate_buffers()
+
         # Calculate projected_points, points_cam_frame, projection_mask
         self.project_point_cloud()
 
@@ -68,6 +75,10 @@ class CameraLidarCalibrator:
                                      visualize=visualize)
         gc.collect()
         print('Image edge-detection completed.')
+
+        # Keep the edge images on the GPU for the GMM cost if CUDA is usable
+        self.upload_edge_images()
+
         print('Executing point cloud edge-detection.')
         with warnings.catch_warnings():
             # ignore runtime warning of ckdtree
@@ -90,6 +101,82 @@ class CameraLidarCalibrator:
         # Optimization parameters
         self.num_iterations = 0
 
+    def __getstate__(self):
+        """Pickle without the stacked point clouds, the buffers and the
+        projections. They are derived from the point clouds and tau, and
+        would double the size of a saved calibrator."""
+        state = self.__dict__.copy()
+        for name in ('pcs_concat', 'pcs_offsets', 'pcs_frame_idxs',
+                     'refl_levels_concat', 'imgs_gray_stack',
+                     'points_cam_frame_buf', 'points_homo_buf',
+                     'projected_points_buf', 'projection_mask_buf',
+                     'inside_mask_buf', 'rotated_points_buf',
+                     'rotated_homo_buf', 'rotated_R', 'cost_components_buf',
+                     'img_edge_scores_gpu', 'imgs_edges_integral_gpu',
+                     'projected_points', 'points_cam_frame',
+                     'projection_mask'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        """Rebuild what __getstate__ dropped. Calibrators pickled before the
+        buffers existed are loaded the same way."""
+        self.__dict__.update(state)
+        self.allocate_buffers()
+        self.upload_edge_images()
+        self.project_point_cloud()
+
+    def allocate_buffers(self):
+        """Stack the point clouds of all frames and allocate the buffers that
+        the projection and the costs reuse on every call."""
+        # Stack the point clouds of all frames so that each projection is a
+        # single product over the whole dataset. Projection runs in float32,
+        # which is plenty for pixel accuracy and halves the memory traffic
+        self.pcs_concat = np.vstack(self.pc_detector.pcs).astype(
+            np.float32, copy=False)
+        self.pcs_offsets = np.cumsum(
+            [0] + [pc.shape[0] for pc in self.pc_detector.pcs])
+
+        # Frame index and reflectance level of every stacked point, and the
+        # stacked grayscale images, to compute the MI of all frames at once
+        self.pcs_frame_idxs = np.repeat(np.arange(self.num_frames),
+                                        np.diff(self.pcs_offsets))
+        self.refl_levels_concat = np.clip(
+            (np.concatenate(self.pc_detector.reflectances) * 255.0).astype(
+                np.int64), 0, 255)
+        self.imgs_gray_stack = np.stack(
+            [img_gray[:self.img_detector.img_h, :self.img_detector.img_w]
+             for img_gray in self.img_detector.imgs_gray])
+
+        # Output buffers of project_point_cloud, reused by every call
+        num_points = self.pcs_concat.shape[0]
+        self.points_cam_frame_buf = np.empty((num_points, 3), dtype=np.float32)
+        self.points_homo_buf = np.empty((num_points, 3), dtype=np.float32)
+        self.projected_points_buf = np.empty((num_points, 2), dtype=np.float32)
+        self.projection_mask_buf = np.empty(num_points, dtype=bool)
+        self.inside_mask_buf = np.empty(num_points, dtype=bool)
+
+        # Rotated points, reused while only the translation changes
+        self.rotated_points_buf = np.empty((num_points, 3), dtype=np.float32)
+        self.rotated_homo_buf = np.empty((num_points, 3), dtype=np.float32)
+        self.rotated_R = None
+
+        # Loss components [mi, gmm, points, corr], reused by every loss call
+        self.cost_components_buf = np.zeros(4)
+
+    def upload_edge_images(self):
+        """Copy the edge scores and their integral images to the GPU for the
+        CUDA GMM kernel, if CuPy is installed and CUDA is available."""
+        self.img_edge_scores_gpu = None
+        self.imgs_edges_integral_gpu = None
+        if cp is not None and cuda.is_available():
+            self.img_edge_scores_gpu = [
+                cp.asarray(img_edge_scores)
+                for img_edge_scores in self.img_detector.img_edge_scores]
+            self.imgs_edges_integral_gpu = [
+                cp.asarray(edges_integral)
+                for edges_integral in self.img_detector.imgs_edges_integral]
+
     def select_correspondences(self):
         """Generate synthetic lidar image for each image-scan pair. Allow user
         to manually select correspondences.
@@ -107,7 +194,9 @@ class CameraLidarCalibrator:
         ref_pt = np.asarray([0, 0], dtype=np.uint)
         ref_pt_3D = np.asarray([0, 0, 0], dtype=np.float32)
 
-        pc_pixel_tree = None
+        img_h, img_w = self.img_detector.img_h, self.img_detector.img_w
+        pc_pixel_labels = None
+        label_to_pc_idx = None
         curr_pc_pixels = None
         curr_pc = None
 
@@ -116,47 +205,67 @@ class CameraLidarCalibrator:
                 if curr_img_name == "gray":
                     ref_pt[0], ref_pt[1] = x, y
                 else:
-                    d, i = pc_pixel_tree.query(
-                        np.asarray([x, y]).reshape((1, 2)), 1)
-                    nearest_pixel = curr_pc_pixels[i, :].astype(np.uint)[0]
+                    i = label_to_pc_idx[pc_pixel_labels[min(y, img_h - 1),
+                                                        min(x, img_w - 1)]]
+                    nearest_pixel = curr_pc_pixels[i, :].astype(np.uint)
                     ref_pt[0], ref_pt[1] = nearest_pixel[0], nearest_pixel[1]
                     ref_pt_3D[:] = curr_pc[i, :]
 
         for frame_idx in range(self.num_frames):
             curr_pc = self.pc_detector.pcs[frame_idx]
             curr_pc_pixels = self.projected_points[frame_idx]
-            pc_pixel_tree = cKDTree(curr_pc_pixels)
 
-            img_gray = cv.cvtColor(self.img_detector.imgs[frame_idx],
-                                   cv.COLOR_BGR2GRAY)
+            # Label every pixel with its nearest projected point (Voronoi
+            # diagram on the pixel grid) so clicks are resolved by a lookup
+            pc_idxs = np.flatnonzero(self.projection_mask[frame_idx])
+            pixels = curr_pc_pixels[pc_idxs].astype(np.int64)
+            xs = np.minimum(pixels[:, 0], img_w - 1)
+            ys = np.minimum(pixels[:, 1], img_h - 1)
+            seeds = np.ones((img_h, img_w), dtype=np.uint8)
+            seeds[ys, xs] = 0
+            _, pc_pixel_labels = cv.distanceTransformWithLabels(
+                seeds, cv.DIST_L2, 5, labelType=cv.DIST_LABEL_PIXEL)
+            label_to_pc_idx = np.zeros(pc_pixel_labels.max() + 1,
+                                       dtype=np.int64)
+            label_to_pc_idx[pc_pixel_labels[ys, xs]] = pc_idxs
+
+            img_gray = self.img_detector.imgs_gray[frame_idx]
             img_synthetic = gen_synthetic_image(
                 curr_pc, self.pc_detector.reflectances[frame_idx], self.R,
                 self.T, self.K,
                 (self.img_detector.img_h, self.img_detector.img_w))
 
+            # Convert to BGR once, the loop only draws the marker on top
+            img_gray_bgr = cv.cvtColor(img_gray, cv.COLOR_GRAY2BGR)
+            img_synthetic_bgr = cv.cvtColor(img_synthetic, cv.COLOR_GRAY2BGR)
+
             cv.namedWindow("Correspondences")
             cv.setMouseCallback("Correspondences", correspondence_cb)
 
             gray_pixels = []
             lidar_pixels = []
             lidar_points = []
+            marker_rad = 2
             while True:
                 if points_selected % 2 == 0:
-                    curr_img = img_gray
+                    curr_img = img_gray_bgr
                     curr_img_name = "gray"
                 else:
-                    curr_img = img_synthetic
+                    curr_img = img_synthetic_bgr
                     curr_img_name = "synthetic"
 
-                curr_img = np.repeat(np.expand_dims(curr_img, axis=2),
-                                     3,
-                                     axis=2)
-                curr_img = cv.circle(curr_img,
-                                     tuple(ref_pt),
-                                     radius=2,
-                                     color=(255, 0, 0),
-                                     thickness=-1)
+                # Draw the marker, then restore the pixels underneath it
+                x, y = int(ref_pt[0]), int(ref_pt[1])
+                roi = (slice(max(y - marker_rad, 0), y + marker_rad + 1),
+                       slice(max(x - marker_rad, 0), x + marker_rad + 1))
+                roi_backup = curr_img[roi].copy()
+                cv.circle(curr_img,
+                          (x, y),
+                          radius=marker_rad,
+                          color=(255, 0, 0),
+                          thickness=-1)
                 cv.imshow("Correspondences", curr_img)
+                curr_img[roi] = roi_backup
                 key = cv.waitKey(1)
 
                 if key == ord('y'):
@@ -202,6 +311,10 @@ class CameraLidarCalibrator:
         self.R, self.T = R, T
         self.tau = tau_new
 
+        # Fold the intrinsics into the extrinsics for projecting points
+        self.KR = np.dot(self.K, self.R)
+        self.KT = np.dot(self.K, self.T)
+
     @staticmethod
     def transform_to_tau(R, T):
         """Given rotation and translation matrices/vectors, compute the
@@ -235,6 +348,23 @@ class CameraLidarCalibrator:
         T = tau[3:].reshape((3, 1))
         return R, T
 
+    @staticmethod
+    def tau_batch_to_transforms(taus):
+        """Given a batch of extrinsics vectors, compute all rotation matrices
+        and translation vectors at once.
+
+        Batched counterpart of tau_to_transform, converting all rotation
+        vectors in a single call instead of one cv2.Rodrigues call each.
+
+        :param taus: (N, 6) numpy array of extrinsics vectors.
+        :return: [R, T], where R is (N, 3, 3) numpy array, T is (N, 3) numpy
+                 array.
+        """
+        taus = np.atleast_2d(taus)
+        R = Rotation.from_rotvec(taus[:, :3]).as_matrix()
+        T = taus[:, 3:]
+        return R, T
+
     def project_point_cloud(self):
         """For each image-scan pair, project the pointcloud onto the image using
         current extrinsics. Compute a binary mask indicating the points that
@@ -243,44 +373,58 @@ class CameraLidarCalibrator:
         Transform all points of the point cloud into the camera frame and then
         projects all points to the image plane. Also store a binary mask to
         obtain all points with a valid projection within image boundaries.
-        """
-        # Compute R and T from current tau
-        self.R, self.T = self.tau_to_transform(self.tau)
-
-        # Remove previous projection
-        self.points_cam_frame = []
-        self.projected_points = []
-        self.projection_mask = []
-
-        for pc in self.pc_detector.pcs:
-            one_mat = np.ones((pc.shape[0], 1))
-            point_cloud = np.concatenate((pc, one_mat), axis=1)
-
-            # Transform points into the camera frame
-            self.points_cam_frame.append(
-                np.matmul(np.hstack((self.R, self.T)), point_cloud.T).T)
-
-            # Project points into image plane and normalize
-            projected_points = np.dot(self.K, self.points_cam_frame[-1].T)
-            projected_points = projected_points[::] / projected_points[::][-1]
-            projected_points = np.delete(projected_points, 2, axis=0)
-            self.projected_points.append(projected_points.T)
-
-            # Remove points that were behind the camera
-            in_front_of_camera_mask = self.points_cam_frame[-1][:, 2] > 0
 
-            # Remove projected points that are outside of the image
-            inside_mask_x = np.logical_and(
-                (projected_points.T[:, 0] >= 0),
-                (projected_points.T[:, 0] <= self.img_detector.img_w))
-            inside_mask_y = np.logical_and(
-                (projected_points.T[:, 1] >= 0),
-                (projected_points.T[:, 1] <= self.img_detector.img_h))
-            inside_mask = np.logical_and(inside_mask_x, inside_mask_y)
-
-            # Final projection mask
-            self.projection_mask.append(
-                np.logical_and(inside_mask, in_front_of_camera_mask))
+        The results are views into buffers that are overwritten by the next
+        call. Copy them to keep the projection of the current extrinsics.
+        The rotated points are kept between calls, so that when only the
+        translation changed, the points are just shifted instead of
+        multiplied again.
+        """
+        # Compute R, T, KR and KT from current tau
+        self.update_extrinsics(self.tau)
+
+        # Cast the extrinsics to the precision of the point clouds
+        R_T, T_T = self.R.T.astype(np.float32), self.T.T.astype(np.float32)
+        KR_T, KT_T = self.KR.T.astype(np.float32), self.KT.T.astype(np.float32)
+
+        points_cam_frame = self.points_cam_frame_buf
+        points_homo = self.points_homo_buf
+        projected_points = self.projected_points_buf
+        projection_mask = self.projection_mask_buf
+
+        # Rotate points of all frames, unless the rotation is unchanged
+        if self.rotated_R is None or \
+                not np.array_equal(self.rotated_R, self.R):
+            np.matmul(self.pcs_concat, R_T, out=self.rotated_points_buf)
+            np.matmul(self.pcs_concat, KR_T, out=self.rotated_homo_buf)
+            self.rotated_R = self.R.copy()
+
+        # Transform points of all frames into the camera frame
+        np.add(self.rotated_points_buf, T_T, out=points_cam_frame)
+
+        # Project points into image plane and normalize
+        np.add(self.rotated_homo_buf, KT_T, out=points_homo)
+        depth = points_homo[:, 2:3]
+        np.divide(points_homo[:, :2], depth, out=projected_points)
+
+        # Remove points that were behind the camera and projected points
+        # that are outside of the image
+        inside_mask = self.inside_mask_buf
+        pixels_x, pixels_y = projected_points[:, 0], projected_points[:, 1]
+        np.greater(depth[:, 0], 0, out=projection_mask)
+        for compare, values, bound in (
+                (np.greater_equal, pixels_x, 0),
+                (np.less_equal, pixels_x, self.img_detector.img_w),
+                (np.greater_equal, pixels_y, 0),
+                (np.less_equal, pixels_y, self.img_detector.img_h)):
+            compare(values, bound, out=inside_mask)
+            np.logical_and(projection_mask, inside_mask, out=projection_mask)
+
+        # Split the results into views per frame
+        split_idxs = self.pcs_offsets[1:-1]
+        self.points_cam_frame = np.split(points_cam_frame, split_idxs)
+        self.projected_points = np.split(projected_points, split_idxs)
+        self.projection_mask = np.split(projection_mask, split_idxs)
 
     def draw_all_points(self, score=None, img=None, frame=-1, show=False):
         """Draw projected points on the image provided.
@@ -307,10 +451,7 @@ class CameraLidarCalibrator:
         projected_points_valid = self.projected_points[frame][
             self.projection_mask[frame]]
 
-        for pixel, color in zip(projected_points_valid, colors_valid):
-            cv2.circle(image,
-                       (pixel[0].astype(np.int), pixel[1].astype(np.int)), 1,
-                       color.tolist(), -1)
+        draw_pixels(image, projected_points_valid, colors_valid, radius=1)
 
         if show:
             cv.imshow('Projected Point Cloud on Image', image)
@@ -337,16 +478,11 @@ class CameraLidarCalibrator:
         reflectance_values = self.pc_detector.reflectances[frame][
             self.projection_mask[frame]]
 
-        for pixel, reflectance in zip(projected_points_valid,
-                                      reflectance_values):
-            refl_img[pixel[1].astype(np.int),
-                     pixel[0].astype(np.int)] = reflectance
+        draw_pixels(refl_img, projected_points_valid, reflectance_values)
 
         if show:
             cv.imshow('Projected Point Cloud Reflectance Image', refl_img)
-            cv.imshow(
-                'Grayscale img',
-                cv.cvtColor(self.img_detector.imgs[frame], cv.COLOR_BGR2GRAY))
+            cv.imshow('Grayscale img', self.img_detector.imgs_gray[frame])
             cv.waitKey(0)
             cv.destroyAllWindows()
 
@@ -368,8 +504,8 @@ class CameraLidarCalibrator:
             self.projection_mask[frame],
             self.pc_detector.pcs_edge_masks[frame])]
 
-        for pixel in projected_points_valid:
-            image[pixel[1].astype(np.int), pixel[0].astype(np.int)] = True
+        draw_pixels(image, projected_points_valid, True,
+                    per_pixel_values=False)
 
         if show:
             cv.imshow('Projected Edge Points on Image', image)
@@ -403,8 +539,7 @@ class CameraLidarCalibrator:
             self.projection_mask[frame],
             self.pc_detector.pcs_edge_masks[frame])]
 
-        for pixel, color in zip(projected_points_valid, colors_valid):
-            image[pixel[1].astype(np.int), pixel[0].astype(np.int), :] = color
+        draw_pixels(image, projected_points_valid, colors_valid)
 
         if save:
             now = datetime.now()
@@ -424,23 +559,18 @@ class CameraLidarCalibrator:
         print Color(HSV's H value) corresponding to score
         """
         if score is None:
-            score = np.sqrt(
-                np.power(self.points_cam_frame[frame][:, 0], 2) +
-                np.power(self.points_cam_frame[frame][:, 1], 2) +
-                np.power(self.points_cam_frame[frame][:, 2], 2))
+            score = np.linalg.norm(self.points_cam_frame[frame], axis=1)
 
-        np.clip(score, 0, max_d, out=score)
+        score = np.clip(score, 0, max_d)
         # max distance is 120m but usually not usual
 
-        norm = plt.Normalize()
-        colors = plt.cm.jet(norm(score))
+        return jet_colors(score)
 
-        return (colors[:, :3] * 255).astype(np.uint8)
-
-    def draw_points(self, image=None, FULL=True):
+    def draw_points(self, image=None, FULL=True, frame=-1):
         """
         Draw points within corresponding camera's FoV on image provided.
         If no image provided, points are drawn on an empty(black) background.
+        If FULL is False, only a random tenth of the points is drawn.
         """
 
         if image is not None:
@@ -450,96 +580,116 @@ class CameraLidarCalibrator:
 
             hsv_image = cv.cvtColor(image, cv.COLOR_BGR2HSV)
         else:
-            hsv_image = np.zeros(self.img_detector.imgs.shape).astype(np.uint8)
-
-        color = self.pc_to_colors()
-        if FULL:
-            index = range(self.projected_points.shape[0])
-        else:
-            index = np.random.choice(self.projected_points.shape[0],
-                                     size=int(self.projected_points.shape[0] /
-                                              10),
+            hsv_image = np.zeros(
+                (self.img_detector.img_h, self.img_detector.img_w, 3),
+                dtype=np.uint8)
+
+        index = np.flatnonzero(self.projection_mask[frame])
+        if not FULL:
+            index = np.random.choice(index,
+                                     size=int(index.shape[0] / 10),
                                      replace=False)
-        for i in index:
-            if pc[i, 0] < 0:
-                continue
-            if self.projection_mask[i] is False:
-                continue
 
-            cv.circle(hsv_image, (np.int32(self.projected_points[i, 0]),
-                                  np.int32(self.projected_points[i, 1])), 1,
-                      (int(color[i]), 255, 255), -1)
+        hsv_colors = np.full((index.shape[0], 3), 255, dtype=np.uint8)
+        hsv_colors[:, 0] = self.pc_to_colors(frame=frame)[index]
+        draw_pixels(hsv_image, self.projected_points[frame][index], hsv_colors,
+                    radius=1)
 
         return cv.cvtColor(hsv_image, cv.COLOR_HSV2BGR)
 
-    def pc_to_colors(self, min_d=0, max_d=120):
+    def pc_to_colors(self, frame=-1, min_d=0, max_d=120):
         """
         print Color(HSV's H value) corresponding to distance(m)
         close distance = red , far distance = blue
         """
-        dist = np.sqrt(
-            np.add(np.power(self.pc_detector.pcs[:, 0], 2),
-                   np.power(self.pc_detector.pcs[:, 1], 2),
-                   np.power(self.pc_detector.pcs[:, 2], 2)))
-        np.clip(dist, 0, max_d, out=dist)
+        dist = np.linalg.norm(self.pc_detector.pcs[frame], axis=1)
+        np.clip(dist, min_d, max_d, out=dist)
         # max distance is 120m but usually not the case
-        return (((dist - min_d) / (max_d - min_d)) * 120).astype(np.uint8)
+        dist -= min_d
+        dist *= 120.0 / (max_d - min_d)
+        return dist.astype(np.uint8)
 
-    def compute_mi_cost(self, frame=-1):
+    def compute_mi_cost(self, frame=-1, bandwidth=1.0):
         """For selected image-scan pair, compute mutual information cost.
 
-        Using locations of projected lidar points that land within image bounds,
-        generate vector of the grayscale intensities, and vector of reflection
-        intensities. Model distribution of each using a Kernel Density Estimate
-        (KDE). Compute the mutual information between the two random variables.
+        See compute_mi_costs, which computes the cost of all pairs at once.
 
         :param frame: Integer index indicating the image-scan pair.
+        :param bandwidth: Standard deviation in intensity levels of the
+                          Gaussian used to smooth the joint histogram.
         :return: Negative of the Mutual information cost.
         """
-        self.project_point_cloud()
-        grayscale_img = cv.cvtColor(self.img_detector.imgs[frame],
-                                    cv.COLOR_BGR2GRAY)
-        projected_points_valid = self.projected_points[frame][self.projection_mask[frame], :]
-
-        grayscale_vector = np.expand_dims(
-            grayscale_img[projected_points_valid[:, 1].astype(np.uint),
-                          projected_points_valid[:, 0].astype(np.uint)], 1)
-        reflectance_vector = np.expand_dims(
-            (self.pc_detector.reflectances[frame][self.projection_mask[frame]] *
-             255.0), 1).astype(np.int)
-
-        if len(reflectance_vector) > 0 and len(grayscale_vector) > 0:
-
-            joint_data = np.hstack([grayscale_vector, reflectance_vector])
-            intensity_vector = np.linspace(-1, 256, 510)
-            grid_x, grid_y = np.meshgrid(intensity_vector, intensity_vector)
-            grid_data = np.vstack([grid_y.ravel(), grid_x.ravel()])
-            grid_data = grid_data.T
-
-            gray_probs = FFTKDE(
-                bw='silverman').fit(grayscale_vector).evaluate(intensity_vector)
-
-            refl_probs = FFTKDE(bw='silverman').fit(
-                reflectance_vector).evaluate(intensity_vector)
-            joint_probs = FFTKDE().fit(joint_data).evaluate(grid_data)
+        return self.compute_mi_costs(bandwidth)[frame]
 
-            gray_probs /= np.sum(gray_probs)
-            refl_probs /= np.sum(refl_probs)
+    def compute_mi_costs(self, bandwidth=1.0):
+        """For all image-scan pairs, compute mutual information cost.
 
-            joint_probs /= np.sum(joint_probs)
-            mi_cost = entropy(gray_probs) + \
-                entropy(refl_probs) - entropy(joint_probs)
-            mi_cost = mi_cost
-
-        else:
-            mi_cost = 0
-        return -mi_cost
-
-    def compute_chamfer_dists(self):
+        Using locations of projected lidar points that land within image bounds,
+        generate vector of the grayscale intensities, and vector of reflection
+        intensities. Model their joint distribution with a 256x256 histogram
+        smoothed by a Gaussian, and each marginal with a 256 bin histogram
+        smoothed with the bandwidth of Silverman's rule. These are the
+        bandwidths of the KDEs this replaces, so the cost keeps their scale.
+        Compute the mutual information between the two random variables.
+
+        The histograms of all frames are counted with a single np.bincount
+        and smoothed as the channels of one (256, 256, num_frames) image.
+        Uses the projection of the last call to project_point_cloud.
+
+        :param bandwidth: Standard deviation in intensity levels of the
+                          Gaussian used to smooth the joint histogram.
+        :return: (num_frames, ) negative mutual information of each frame,
+                 0 for frames without projected points.
+        """
+        mask = self.projection_mask_buf
+        frame_idxs = self.pcs_frame_idxs[mask]
+        pixels = self.projected_points_buf[mask].astype(np.int64)
+        xs = np.minimum(pixels[:, 0], self.img_detector.img_w - 1)
+        ys = np.minimum(pixels[:, 1], self.img_detector.img_h - 1)
+
+        gray_levels = self.imgs_gray_stack[frame_idxs, ys, xs].astype(np.int64)
+        refl_levels = self.refl_levels_concat[mask]
+
+        joint_hist = np.bincount(
+            (gray_levels * 256 + refl_levels) * self.num_frames + frame_idxs,
+            minlength=256 * 256 * self.num_frames).reshape(
+                256, 256, self.num_frames).astype(np.float64)
+        mi_costs = np.zeros(self.num_frames)
+        has_points = np.sum(joint_hist, axis=(0, 1)) > 0
+        if not np.any(has_points):
+            return mi_costs
+        joint_hist = joint_hist[:, :, has_points]
+
+        joint_probs = cv.GaussianBlur(joint_hist, (0, 0), sigmaX=bandwidth)
+        joint_probs = joint_probs.reshape(joint_hist.shape)
+
+        # Smooth the (256, 2 * frames) marginal histograms at once with one
+        # (256, 256) Gaussian matrix per histogram
+        marginal_hists = np.hstack((np.sum(joint_hist, axis=1),
+                                    np.sum(joint_hist, axis=0)))
+        sigmas = silverman_bandwidths(marginal_hists)
+        level_diffs = np.subtract.outer(np.arange(256), np.arange(256))
+        smoothing = np.exp(-np.square(level_diffs) /
+                           (2 * np.square(sigmas[:, None, None])))
+        marginal_probs = np.einsum('kij,jk->ik', smoothing, marginal_hists)
+        gray_probs, refl_probs = np.split(marginal_probs, 2, axis=1)
+
+        mi_costs[has_points] = entropy(gray_probs) + entropy(refl_probs) - \
+            entropy(joint_probs.reshape(256 * 256, -1))
+        return -mi_costs
+
+    def compute_chamfer_dists(self, trunc_dist=None):
         """
         For each image-scan pair, compute the chamfer distance. Count the number
         of edge points used in the distance calculation.
 
+        The distance maps of the image edges hold the exact distance to the
+        nearest edge, so each lidar edge point is a single lookup instead of a
+        nearest-neighbor search.
+
+        :param trunc_dist: If given, distances are truncated to this value so
+                           that outliers without a matching image edge add a
+                           bounded penalty.
         :return: Average distance between edge points in a Lidar image and
         camera image.
         """
@@ -547,20 +697,26 @@ class CameraLidarCalibrator:
         total_edge_pts = 0
 
         for frame_idx in range(self.num_frames):
-            cam_edges = self.img_detector.imgs_edges[frame_idx]
-            cam_edges_inv = 255*np.logical_not(cam_edges).astype(np.uint8)
-            cam_dist_map = cv.distanceTransform(cam_edges_inv, cv.DIST_L2,
-                                                cv.DIST_MASK_PRECISE)
-            lid_edges = self.draw_edge_points_binary(frame_idx)
-            num_edge_pts = lid_edges.sum()
-            dist = np.multiply(lid_edges, cam_dist_map).sum()
+            cam_dist_map = self.img_detector.imgs_dist_maps[frame_idx]
+
+            # Sample the distance map at the projected lidar edge points
+            lid_edges = self.projected_points[frame_idx][np.logical_and(
+                self.projection_mask[frame_idx],
+                self.pc_detector.pcs_edge_masks[frame_idx])].astype(np.int64)
+            xs = np.minimum(lid_edges[:, 0], cam_dist_map.shape[1] - 1)
+            ys = np.minimum(lid_edges[:, 1], cam_dist_map.shape[0] - 1)
+            dist = cam_dist_map[ys, xs]
+            if trunc_dist is not None:
+                dist = np.minimum(dist, trunc_dist)
+            dist = dist.sum()
 
             total_dist += dist
-            total_edge_pts += num_edge_pts
+            total_edge_pts += lid_edges.shape[0]
 
         return total_dist/total_edge_pts
 
-    def compute_conv_cost(self, sigma_in, frame=-1, sigma_scaling=True):
+    def compute_conv_cost(self, sigma_in, frame=-1, sigma_scaling=True,
+                          sigma_buckets=None):
         """For selected image-scan pair, compute GMM cost
 
         For each points within camera's FoV and above edge score
@@ -571,63 +727,84 @@ class CameraLidarCalibrator:
         :param: frame: Integer index indicating the image-scan pair
         :param: sigma_scaling: Boolean indicating whether to scale using the
                                distance of each point
+        :param: sigma_buckets: If given, quantize the scaled sigmas into this
+                               many bins and build one kernel per bin
+                               instead of one per point
         :return: Negative of the GMM cost
         """
-        # start_t = time.time()
-        cost_map = np.zeros(self.img_detector.img_edge_scores[frame].shape)
-        for idx_pc in range(self.pc_detector.pcs_edge_idxs[frame].shape[0]):
-
-            idx = self.pc_detector.pcs_edge_idxs[frame][idx_pc]
-
-            # check if projected projected point lands within image bounds
-            if not self.projection_mask[frame][idx]:
-                continue
-
-            if sigma_scaling:
-                sigma = (
-                    sigma_in /
-                    np.linalg.norm(self.points_cam_frame[frame][idx, :], 2))
+        img_edge_scores = self.img_detector.img_edge_scores[frame]
+        img_h, img_w = img_edge_scores.shape
+        cost_map = np.zeros(img_edge_scores.shape)
+
+        # Keep edge points that land within image bounds
+        edge_idxs = self.pc_detector.pcs_edge_idxs[frame]
+        edge_idxs = edge_idxs[self.projection_mask[frame][edge_idxs]]
+        mu = self.projected_points[frame][edge_idxs].astype(np.int64)
+        inside_mask = np.logical_and(mu[:, 0] < img_w, mu[:, 1] < img_h)
+        edge_idxs, mu = edge_idxs[inside_mask], mu[inside_mask]
+
+        # Get gaussian kernels
+        # Distance > 3 sigma is set to 0
+        # and normalized so that the total Kernel = 1
+        if sigma_scaling:
+            sigmas = sigma_in / np.linalg.norm(
+                self.points_cam_frame[frame][edge_idxs, :], axis=1)
+            if sigma_buckets and sigmas.size:
+                bucket_sigmas, kernel_idxs = quantize_sigmas(sigmas,
+                                                             sigma_buckets)
+                sigmas = bucket_sigmas[kernel_idxs]
+                kernels = getGaussianKernels1D(bucket_sigmas)
             else:
-                sigma = sigma_in
-
-            mu_x, mu_y = self.projected_points[frame][idx].astype(np.int)
-            # Get gaussian kernel
-            # Distance > 3 sigma is set to 0
-            # and normalized so that the total Kernel = 1
-            gauss2d = getGaussianKernel2D(sigma)
-            top, bot, left, right = get_boundry(
-                self.img_detector.img_edge_scores[frame], (mu_y, mu_x),
-                int(sigma))
-            # Get image patch inside the kernel
-            edge_scores_patch = \
-                self.img_detector.img_edge_scores[frame][
-                    mu_y - top:mu_y + bot,
-                    mu_x - left:mu_x + right
-                ].copy()
-
-            # weight = (normalized img score + normalized pc score) / 2
-            # weight = weight / |Omega_i|
-            # Cost = Weight * Gaussian Kernel
-            num_nonzeros = np.sum(edge_scores_patch != 0)
-            if num_nonzeros == 0:
-                continue
-
-            edge_scores_patch[edge_scores_patch != 0] += \
-                self.pc_detector.pcs_edge_scores[frame][idx]
-
-            kernel_patch = gauss2d[3 * int(sigma) - top:3 * int(sigma) + bot,
-                                   3 * int(sigma) - left:3 * int(sigma) + right]
-
-            cost_patch = np.multiply(edge_scores_patch, kernel_patch)
-
-            # Normalize by number of edge projected_points in the neighborhood
-            cost_map[mu_y, mu_x] = \
-                np.sum(cost_patch) / (2 * np.sum(edge_scores_patch > 0))
+                kernels = getGaussianKernels1D(sigmas)
+                kernel_idxs = np.arange(edge_idxs.shape[0])
+        else:
+            sigmas = np.full(edge_idxs.shape[0], sigma_in)
+            kernels = getGaussianKernel1D(sigma_in).T
+            kernel_idxs = np.zeros(edge_idxs.shape[0], dtype=np.int64)
+
+        # weight = (normalized img score + normalized pc score) / 2
+        # weight = weight / |Omega_i|
+        # Cost = Weight * Gaussian Kernel
+        kernel_args = (np.ascontiguousarray(mu[:, 0]),
+                       np.ascontiguousarray(mu[:, 1]),
+                       3 * sigmas.astype(np.int64), kernel_idxs,
+                       np.ascontiguousarray(kernels),
+                       self.pc_detector.pcs_edge_scores[frame][edge_idxs])
+        if self.img_edge_scores_gpu is not None:
+            conv_cost_cuda(*kernel_args, self.img_edge_scores_gpu[frame],
+                           self.imgs_edges_integral_gpu[frame], cost_map)
+        else:
+            conv_cost_kernel(*kernel_args, img_edge_scores,
+                             self.img_detector.imgs_edges_integral[frame],
+                             cost_map)
 
         # plot_2d(cost_map)
-        gc.collect()
         return -np.sum(cost_map)
 
+    def compute_conv_cost_fast(self, sigma_in, frame=-1):
+        """For selected image-scan pair, compute an approximate GMM cost
+
+        Instead of convolving a Gaussian around each projected edge point,
+        sample the image edge scores blurred once with the same Gaussian at
+        the projected points and weight them with the point edge scores.
+        Sigma is not scaled by the distance of each point.
+
+        :param: sigma_in: standard deviation for gaussian kernel
+        :param: frame: Integer index indicating the image-scan pair
+        :return: Negative of the approximate GMM cost
+        """
+        blurred_scores = \
+            self.img_detector.get_blurred_edge_scores(sigma_in)[frame]
+
+        edge_mask = np.logical_and(self.projection_mask[frame],
+                                   self.pc_detector.pcs_edge_masks[frame])
+        pixels = self.projected_points[frame][edge_mask].astype(np.int64)
+        xs = np.minimum(pixels[:, 0], blurred_scores.shape[1] - 1)
+        ys = np.minimum(pixels[:, 1], blurred_scores.shape[0] - 1)
+
+        return -np.sum(self.pc_detector.pcs_edge_scores[frame][edge_mask] *
+                       blurred_scores[ys, xs])
+
     def compute_corresp_cost(self, norm_thresh=5):
         """Compute re-projection error for all correspondences.
 
@@ -646,33 +823,92 @@ class CameraLidarCalibrator:
         """
         """Return average distance between all correspondences"""
         pixel_distances = []
-        num_corresp = 0
         dist_offset = np.sqrt(self.img_detector.img_w**2 +
                               self.img_detector.img_h**2) * 3
 
         for matches in self.correspondences:
             gray_pixels = matches[0]
             lidar_points = matches[1]
-            lidar_points_cam = np.matmul(self.R, lidar_points.T) + self.T
-            lidar_pixels_homo = (np.matmul(self.K, lidar_points_cam).T)
-            lidar_pixels_homo = lidar_pixels_homo / \
-                np.expand_dims(lidar_pixels_homo[:, 2], axis=1)
-            lidar_pixels = lidar_pixels_homo[:, :2]
+            lidar_pixels_homo = np.dot(lidar_points, self.KR.T) + self.KT.T
+            lidar_pixels = lidar_pixels_homo[:, :2] / lidar_pixels_homo[:, 2:]
 
             pixel_diff = gray_pixels - lidar_pixels
-            pixel_distances += np.linalg.norm(pixel_diff, axis=1,
-                                              ord=1).tolist()
-            num_corresp += lidar_pixels.shape[0]
+            pixel_distances.append(np.linalg.norm(pixel_diff, axis=1, ord=1))
 
-        total_dist = 0
-        for dist in pixel_distances:
-            if dist <= norm_thresh:
-                total_dist += dist
-            else:
-                total_dist += (dist**2)
-        average_dist = total_dist / num_corresp
+        pixel_distances = np.concatenate(pixel_distances)
+        total_dist = np.sum(np.where(pixel_distances <= norm_thresh,
+                                     pixel_distances,
+                                     np.square(pixel_distances)))
+        average_dist = total_dist / pixel_distances.size
         return -dist_offset + 3 * average_dist, pixel_distances
 
+    def compute_corresp_residuals(self, taus):
+        """Compute re-projection errors of all correspondences for a batch of
+        extrinsics vectors at once.
+
+        The correspondences are transformed and projected with every
+        extrinsics vector in a single batched product.
+
+        :param taus: (B, 6) numpy array of extrinsics vectors.
+        :return: (B, M) numpy array with the L1 pixel distance of each of the
+                 M correspondences for each extrinsics vector.
+        """
+        gray_pixels = np.vstack([matches[0] for matches in
+                                 self.correspondences])
+        lidar_points = np.vstack([matches[1] for matches in
+                                  self.correspondences])
+
+        Rs, Ts = self.tau_batch_to_transforms(taus)
+        lidar_points_cam = np.einsum('bij,nj->bni', Rs, lidar_points) + \
+            Ts[:, np.newaxis, :]
+        lidar_pixels_homo = np.einsum('ij,bnj->bni', self.K, lidar_points_cam)
+        lidar_pixels = lidar_pixels_homo[:, :, :2] / \
+            lidar_pixels_homo[:, :, 2:]
+
+        return np.linalg.norm(gray_pixels - lidar_pixels, ord=1, axis=2)
+
+    def compute_corresp_jacobian(self, tau):
+        """Compute the Jacobian of the correspondence re-projection errors
+        with respect to the extrinsics analytically.
+
+        The derivative of the rotated points wrt the rotation vector is
+        -skew(R p) J(omega), with J the Jacobian of the rotation vector from
+        data_utils. It is chained through the intrinsics and the perspective
+        division, and the sign of each pixel difference gives the derivative
+        of the L1 errors.
+
+        :param tau: (6, ) extrinsics vector.
+        :return: (M, 6) numpy array, derivative of each of the M errors.
+        """
+        tau = np.squeeze(tau)
+        R, T = self.tau_to_transform(tau)
+        gray_pixels = np.vstack([matches[0] for matches in
+                                 self.correspondences])
+        lidar_points = np.vstack([matches[1] for matches in
+                                  self.correspondences])
+
+        rotated_points = np.dot(lidar_points, R.T)
+        lidar_pixels_homo = np.dot(rotated_points + T.T, self.K.T)
+        lidar_pixels = lidar_pixels_homo[:, :2] / lidar_pixels_homo[:, 2:]
+
+        # (M, 3, 6) derivative of the points in the camera frame, the rows
+        # of skew(q) are the cross products of q with the unit vectors
+        num_corresp = lidar_points.shape[0]
+        skew_rotated = -np.cross(rotated_points[:, np.newaxis, :], np.eye(3))
+        points_cam_jac = np.zeros((num_corresp, 3, 6))
+        points_cam_jac[:, :, :3] = -np.matmul(skew_rotated,
+                                              jacobian(tau[:3]))
+        points_cam_jac[:, :, 3:] = np.eye(3)
+
+        # Chain through the intrinsics and the perspective division
+        pixels_homo_jac = np.matmul(self.K, points_cam_jac)
+        pixels_jac = (pixels_homo_jac[:, :2] -
+                      lidar_pixels[:, :, np.newaxis] * pixels_homo_jac[:, 2:]) \
+            / lidar_pixels_homo[:, 2:, np.newaxis]
+
+        signs = np.sign(gray_pixels - lidar_pixels)
+        return -np.einsum('mi,mij->mj', signs, pixels_jac)
+
     def compute_points_cost(self, frame=-1):
         """Compute the change in the number of points compared to at the start
         of optimization. Return the absolute difference.
@@ -680,9 +916,18 @@ class CameraLidarCalibrator:
         :param frame: Integer index indicating which image-scan pair to use.
         :return: Absolute integer difference in number of projected points.
         """
-        num_points = self.projection_mask[frame].sum()
-        points_diff = abs(self.numpoints_preopt[frame] - num_points)
-        return points_diff
+        return self.compute_points_costs()[frame]
+
+    def compute_points_costs(self):
+        """Compute the change in the number of points compared to at the start
+        of optimization for all image-scan pairs at once.
+
+        :return: (num_frames, ) absolute integer difference in number of
+                 projected points of each frame.
+        """
+        num_points = np.add.reduceat(self.projection_mask_buf,
+                                     self.pcs_offsets[:-1], dtype=np.int64)
+        return np.abs(np.asarray(self.numpoints_preopt) - num_points)
 
     def batch_optimization(self):
         """Optimize over extrinsics and return the optimized parameters
@@ -693,16 +938,16 @@ class CameraLidarCalibrator:
         """
         
         def loss_manual(tau):
-            self.tau = tau
-            self.R, self.T = self.tau_to_transform(tau)
-            self.project_point_cloud()
-            return self.compute_corresp_cost()[1]
+            return self.compute_corresp_residuals(tau)[0]
 
         tau = self.tau.copy()
         print('Start optimization using manually selected correspondances')
-        opt_results = least_squares(loss_manual, tau, method='lm')
- 
-        self.tau = opt_results.x
+        opt_results = least_squares(loss_manual, tau,
+                                    jac=self.compute_corresp_jacobian,
+                                    method='lm')
+
+        self.update_extrinsics(opt_results.x)
+        self.project_point_cloud()
         if self.visualize:
             img = self.draw_all_points(frame=0)
             cv.imshow('Projection with optimized tau', img)
@@ -714,13 +959,15 @@ class CameraLidarCalibrator:
         print('Rotation Vector: ' + str(np.squeeze(self.tau)[3:]))
         return opt_results.x
 
-    def ls_optimize(self, hyperparams, maxiter=600):
+    def ls_optimize(self, hyperparams, maxiter=600, save_every=50):
         """Optimize over extrinsics and return the optimized parameters.
 
         :param hyperparams: Dictionary with scaling coefficients for each cost
                             component, sigma value for GMM, and scaling array
                             for the extrinsics vector during optimization.
         :param maxiter: Integer limit for number of optimizer iterations.
+        :param save_every: Save the current projection every save_every
+                           iterations, 0 disables saving.
         :return: [tau, cost]. tau is a (6, 1) optimized extrinsics vector.
                  cost is a list with the history of loss over the optimization.
         """
@@ -749,8 +996,12 @@ class CameraLidarCalibrator:
         self.num_iterations = 0
 
         def loss_callback(xk, state=None):
-            """Save loss graph and point-cloud projection for debugging"""
+            """Save loss graph and point-cloud projection for debugging every
+            save_every iterations"""
             self.num_iterations += 1
+            if not save_every or self.num_iterations % save_every:
+                return False
+
             # if len(cost_history):
             #     plt.close('all')
             #     plt.figure()
@@ -812,7 +1063,8 @@ def loss(tau_scaled, calibrator, hyperparams, cost_history):
     ['mi', 'gmm', 'points', 'corr', 'sigma'],
 
     Hyperparams['scales'] describes how each parameter axis is
-    normalized in the optimization.
+    normalized in the optimization. The optional hyperparams['chamfer_trunc']
+    truncates the distances of the chamfer cost.
 
     :param tau_scaled: (6, 1) extrinsics parameters.
     :param calibrator: CameraLidarCalibrator object containing loaded image-scan
@@ -831,23 +1083,25 @@ def loss(tau_scaled, calibrator, hyperparams, cost_history):
     calibrator.project_point_cloud()
 
     # Compute loss components
-    cost_components = np.zeros((4, 1))
-    for frame_idx in range(calibrator.num_frames):
-        if hyperparams['alphas']['mi']:
-            cost_components[0] += calibrator.compute_mi_cost(frame_idx)
+    cost_components = calibrator.cost_components_buf
+    cost_components.fill(0)
+    if hyperparams['alphas']['mi']:
+        cost_components[0] += np.sum(calibrator.compute_mi_costs())
 
-        # if hyperparams['alphas']['gmm']:
-        #     cost_components[1] += calibrator.compute_conv_cost(
-        #         hyperparams['alphas']['sigma'], frame_idx, sigma_scaling=False)
+    # if hyperparams['alphas']['gmm']:
+    #     for frame_idx in range(calibrator.num_frames):
+    #         cost_components[1] += calibrator.compute_conv_cost(
+    #             hyperparams['alphas']['sigma'], frame_idx, sigma_scaling=False)
 
-        if hyperparams['alphas']['points']:
-            cost_components[2] += calibrator.compute_points_cost(frame_idx)
+    if hyperparams['alphas']['points']:
+        cost_components[2] += np.sum(calibrator.compute_points_costs())
 
     if hyperparams['alphas']['corr']:
-        cost_components[3] += calibrator.compute_corresp_cost()
+        cost_components[3] += calibrator.compute_corresp_cost()[0]
 
     if hyperparams['alphas']['gmm']:
-        cost_components[1] += calibrator.compute_chamfer_dists()
+        cost_components[1] += calibrator.compute_chamfer_dists(
+            hyperparams.get('chamfer_trunc'))
 
     # Scale loss components
     cost_components[0] *= hyperparams['alphas']['mi']
@@ -855,9 +1109,9 @@ def loss(tau_scaled, calibrator, hyperparams, cost_history):
     cost_components[2] *= hyperparams['alphas']['points']
     cost_components[3] *= hyperparams['alphas']['corr']
 
-    total_cost = sum(cost_components)
+    total_cost = float(cost_components.sum())
     cost_history.append(total_cost)
-    return sum(cost_components)
+    return total_cost
 
 
 class RandomDisplacement(object):
@@ -873,12 +1127,9 @@ class RandomDisplacement(object):
     """
 
     def __init__(self, stepsize, random_gen=None):
-        self.stepsize = stepsize
+        self.stepsize = np.asarray(stepsize)
         self.random_gen = check_random_state(random_gen)
 
     def __call__(self, x):
-        for i in range(len(x)):
-            x[i] *= (
-                1 +
-                self.random_gen.uniform(-self.stepsize[i], self.stepsize[i]))
+        x *= 1 + self.random_gen.uniform(-self.stepsize, self.stepsize)
         return x
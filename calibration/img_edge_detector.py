@@ -21,8 +21,15 @@ class ImgEdgeDetector:
             print("Image directory does not exist.")
             exit()
 
+        # Grayscale images are used by every cost evaluation, convert once
+        self.imgs_gray = [cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+                          for img in self.imgs]
+
         self.img_edge_scores = []
         self.imgs_edges = []
+        self.imgs_dist_maps = []
+        self.imgs_edges_integral = []
+        self.blurred_edge_scores = {}
 
         self.ed_thresh_low = cfg.im_ced_score_lower_thr
         self.ed_thresh_high = cfg.im_ced_score_upper_thr
@@ -47,19 +54,19 @@ class ImgEdgeDetector:
 
         model = os.path.join(os.getcwd(), 'calibration/configs/sed_model.yml')
         sed_model = cv.ximgproc.createStructuredEdgeDetection(model)
-        for img in self.imgs:
+        for img, gray in zip(self.imgs, self.imgs_gray):
 
             if method == 'canny':
-                gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-                blurred = gaussian_filter(gray, sigma=2, order=0, mode='reflect')
+                # Filter in float32, Sobel responses are negative on one side
+                blurred = gaussian_filter(gray.astype(np.float32), sigma=2,
+                                          order=0, mode='reflect')
 
                 gradient_x = convolve(
                     blurred, [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
                 gradient_y = convolve(
                     blurred, [[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
 
-                img_edge_scores = np.sqrt(
-                    np.power(gradient_x, 2) + np.power(gradient_y, 2))
+                img_edge_scores = np.hypot(gradient_x, gradient_y)
                 img_edges = cv.Canny(img,
                                      self.ed_thresh_low,
                                      self.ed_thresh_high,
@@ -74,14 +81,77 @@ class ImgEdgeDetector:
                 _, img_edges = cv.threshold(img_edges, 0.25, 1.0, cv.THRESH_BINARY)
                 img_edges = img_edges.astype(np.bool)
 
+            # Edge scores are float32 for any method, which is what the
+            # cost kernels are compiled for
             img_edge_scores[~img_edges] = 0
-            img_edge_scores = img_edge_scores / np.amax(img_edge_scores)
+            img_edge_scores = (img_edge_scores /
+                               np.amax(img_edge_scores)).astype(np.float32)
             self.img_edge_scores.append(img_edge_scores)
             self.imgs_edges.append(img_edges)
 
+        self.compute_edge_maps()
+
         if visualize:
             self.visualize_img_edges(range(len(self.imgs)))
 
+    def compute_edge_maps(self):
+        """
+        Compute the maps derived from the detected edges of all images. The
+        edges are fixed during optimization so these are only computed once.
+        """
+        # Integral image of the edge pixels, counts the edges in any
+        # window of the GMM cost in O(1)
+        self.imgs_edges_integral = [
+            cv.integral((img_edge_scores != 0).astype(np.uint8))
+            for img_edge_scores in self.img_edge_scores]
+
+        # Distance of every pixel to the nearest edge
+        self.imgs_dist_maps = [
+            cv.distanceTransform(255 * (~img_edges).astype(np.uint8),
+                                 cv.DIST_L2, cv.DIST_MASK_PRECISE)
+            for img_edges in self.imgs_edges]
+
+    def __getstate__(self):
+        """
+        Pickle without the grayscale images and the maps derived from the
+        edges, they are rebuilt on load.
+        """
+        state = self.__dict__.copy()
+        for name in ('imgs_gray', 'imgs_edges_integral', 'imgs_dist_maps',
+                     'blurred_edge_scores'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Rebuild what __getstate__ dropped, also for detectors pickled before
+        these were kept.
+        """
+        self.__dict__.update(state)
+        self.imgs_gray = [cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+                          for img in self.imgs]
+        self.blurred_edge_scores = {}
+        self.img_edge_scores = [
+            img_edge_scores.astype(np.float32, copy=False)
+            for img_edge_scores in self.img_edge_scores]
+        self.compute_edge_maps()
+
+    def get_blurred_edge_scores(self, sigma):
+        """
+        Return the edge scores of all images blurred with a Gaussian of
+        standard deviation sigma. The blurred images only depend on the
+        detected edges and sigma, so they are computed once per sigma.
+
+        :param sigma: standard deviation of the Gaussian in pixels
+        :return: list of (H, W) float32 images
+        """
+        if sigma not in self.blurred_edge_scores:
+            self.blurred_edge_scores[sigma] = [
+                cv.GaussianBlur(img_edge_scores, (0, 0), sigmaX=sigma)
+                for img_edge_scores in self.img_edge_scores
+            ]
+        return self.blurred_edge_scores[sigma]
+
     def visualize_img_edges(self, frames=[0]):
         """
         Given the frame index [0, num_frames_loaded], draw the edge image
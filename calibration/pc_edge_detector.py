@@ -6,10 +6,11 @@ from matplotlib import cm as cm
 import open3d as o3d
 from sklearn.cluster import KMeans
 
+from calibration.utils.kernel_utils import *
+
 import time
 import os
 from glob import glob
-from tqdm import tqdm
 
 
 class PcEdgeDetector:
@@ -45,34 +46,11 @@ class PcEdgeDetector:
         for idx, (pc, pc_cam_frame) in enumerate(zip(self.pcs, pcs_cam_frame)):
             print('Point Cloud #{}/{}'.format(idx+1, len(self.pcs)))
             num_points = pc.shape[0]
-            center_scores = np.zeros(num_points)
-            planar_scores = np.zeros(num_points)
 
             start_t = time.time()
             kdtree = ckdtree.cKDTree(pc)
-            for point_idx in tqdm(range(num_points)):
-                curr_xyz = pc[point_idx, :]
-
-                neighbor_d1, neighbor_i1 = kdtree.query(curr_xyz, num_nn)
-                neighbor_i2 = kdtree.query_ball_point(curr_xyz, rad_nn)
-                # remove duplicates
-                neighbor_i2 = list(set(neighbor_i2) - set(neighbor_i1))
-                neighbor_d2 = np.linalg.norm(pc[neighbor_i2, :] - curr_xyz,
-                                             ord=2,
-                                             axis=1)
-                neighbor_i = np.append(neighbor_i1, neighbor_i2).astype(np.int)
-                neighbor_d = np.append(neighbor_d1, neighbor_d2)
-
-                neighborhood_xyz = pc[neighbor_i.tolist(), :]
-
-                center_score = self.compute_centerscore(neighborhood_xyz,
-                                                        curr_xyz,
-                                                        np.max(neighbor_d))
-                planarity_score = self.compute_planarscore(
-                    neighborhood_xyz, curr_xyz)
-
-                center_scores[point_idx] = center_score
-                planar_scores[point_idx] = planarity_score
+            center_scores, planar_scores = self.compute_neighborhood_scores(
+                pc, kdtree, int(num_nn), rad_nn)
 
             # Combine three edge scores
             # (Global normalization, local neighborhood size normalization)
@@ -90,21 +68,27 @@ class PcEdgeDetector:
             pc_edge_scores_3 = (pc_edge_scores_3 - pc_edge_scores_3.min())/(pc_edge_scores_3.max() - pc_edge_scores_3.min())
             pc_edge_scores = pc_edge_scores*pc_edge_scores_3
 
-            # NMS
+            # NMS. As in the former per-point loop, every point is compared
+            # against the neighborhood within 10cm of the last point of the
+            # cloud. That neighborhood's max score only changes when one of
+            # its own points is suppressed, so the points in between are
+            # suppressed in vectorized runs
+            nms_idxs = np.sort(kdtree.query_ball_point(pc[-1, :], 0.10))
             points_suppressed = 0
-            for point_idx in range(num_points):
-                curr_score = pc_edge_scores[point_idx]
-                neighbor_i = kdtree.query_ball_point(curr_xyz, 0.10)
-                neighbor_scores = pc_edge_scores[neighbor_i]
-
-                if (neighbor_scores > curr_score).any():
-                    pc_edge_scores[point_idx] = 0
-                    points_suppressed += 1
-
-            self.pcs_edge_scores.append(pc_edge_scores)
+            start = 0
+            for nms_idx in np.append(nms_idxs, num_points - 1):
+                max_score = np.max(pc_edge_scores[nms_idxs])
+                run_scores = pc_edge_scores[start:nms_idx + 1]
+                suppressed_mask = run_scores < max_score
+                run_scores[suppressed_mask] = 0
+                points_suppressed += np.count_nonzero(suppressed_mask)
+                start = nms_idx + 1
+
+            # Edge scores are stored in float32 like the points themselves
+            self.pcs_edge_scores.append(pc_edge_scores.astype(np.float32))
 
             # Remove all points with an edge score below the threshold
-            thresh = np.percentile(pc_edge_scores, thresh)
+            thresh = np.percentile(self.pcs_edge_scores[-1], thresh)
             self.pcs_edge_masks.append(self.pcs_edge_scores[-1] > thresh)
             # Exclude boundary points in final thresholding
             pc_boundary_idxs = self.get_first_and_last_channels_idxs(pc)
@@ -125,7 +109,8 @@ class PcEdgeDetector:
 
     @staticmethod
     def load_pcs(path, frames, subsample=1.0):
-        """Load pointclouds, separate XYZ and Reflectance components"""
+        """Load pointclouds, separate XYZ and Reflectance components. Both
+        are float32, as stored in the KITTI .bin files."""
         pcs = []
         reflectances = []
 
@@ -148,45 +133,61 @@ class PcEdgeDetector:
                 print("Invalid point-cloud format encountered.")
                 exit()
 
-            pc = curr_pc[:int(subsample * curr_pc.shape[0]), :3]
-            refl = curr_pc[:int(subsample * curr_pc.shape[0]), 3]
+            # Copy out of the interleaved rows, so that the hot loops read
+            # contiguous memory
+            pc = np.ascontiguousarray(
+                curr_pc[:int(subsample * curr_pc.shape[0]), :3])
+            refl = np.ascontiguousarray(
+                curr_pc[:int(subsample * curr_pc.shape[0]), 3])
             pcs.append(pc)
             reflectances.append(refl)
 
         return pcs, reflectances
 
     @staticmethod
-    def compute_centerscore(nn_xyz, center_xyz, max_nn_d):
-        """Description: Compute modified center-based score. Distance between
-        center (center_xyz), and the neighborhood (N x 3) around center_xyz.
-        Result is scaled by max distance in the neighborhood, as done in
-        Kang 2019."""
-
-        centroid = np.mean(nn_xyz, axis=0)
-        norm_dist = np.linalg.norm(center_xyz - centroid) / max_nn_d
-        return norm_dist
-
-    @staticmethod
-    def compute_planarscore(nn_xyz, center_xyz):
-
-        complete_xyz = np.concatenate(
-            [nn_xyz, center_xyz.reshape((1, 3))], axis=0)
-        centroid = np.mean(complete_xyz, axis=0)
-        centered_xyz = complete_xyz - centroid
-
-        # Build structure tensor
-        n_points = centered_xyz.shape[0]
-        s = np.zeros((3, 3))
-        for i in range(n_points):
-            test = np.dot(centered_xyz[i, :].reshape((3, 1)), centered_xyz[i, :].reshape((1, 3)))
-            s += test
-        s /= n_points
-
-        # Compute planarity of neighborhood using SVD (Xia & Wang 2017)
-        _, eig_vals, _ = np.linalg.svd(s)
-        planarity = 1 - (eig_vals[1] - eig_vals[2]) / eig_vals[0]
-
-        return planarity
+    def compute_neighborhood_scores(pc, kdtree, num_nn, rad_nn):
+        """
+        Compute the center and planarity scores of all points. The
+        neighborhood of a point is the union of its num_nn nearest neighbors
+        and its neighbors within rad_nn.
+
+        The nearest neighbors of all points are queried at once. Only points
+        whose num_nn-th neighbor is within rad_nn can have a larger radius
+        neighborhood, so only those get a ball query for their extra
+        neighbors. Both scores of all points are then computed by
+        neighborhood_scores_kernel in a single pass over each neighborhood.
+
+        :param pc: (N, 3) pointcloud.
+        :param kdtree: cKDTree of pc.
+        :param num_nn: Integer min number of nearest neighbors.
+        :param rad_nn: Radius in which to include neighbors.
+        :return: [center_scores, planar_scores], both (N, ) numpy arrays.
+        """
+        num_points = pc.shape[0]
+        neighbor_d, neighbor_i = kdtree.query(pc, num_nn)
+
+        # Extra neighbors within the radius, as offsets into extra_idxs
+        radius_idxs = np.flatnonzero(neighbor_d[:, -1] <= rad_nn)
+        extra_counts = np.zeros(num_points, dtype=np.int64)
+        extra_neighbors = []
+        for point_idx in radius_idxs:
+            extra_i = np.setdiff1d(
+                kdtree.query_ball_point(pc[point_idx, :], rad_nn),
+                neighbor_i[point_idx])
+            extra_counts[point_idx] = extra_i.shape[0]
+            extra_neighbors.append(extra_i)
+        extra_ptrs = np.concatenate([[0], np.cumsum(extra_counts)])
+        extra_idxs = np.concatenate(
+            extra_neighbors + [np.zeros(0)]).astype(np.int64)
+
+        center_scores = np.zeros(num_points)
+        planar_scores = np.zeros(num_points)
+        neighborhood_scores_kernel(
+            np.ascontiguousarray(pc, dtype=np.float64),
+            np.ascontiguousarray(neighbor_i, dtype=np.int64),
+            neighbor_d[:, -1].copy(), extra_ptrs, extra_idxs,
+            center_scores, planar_scores)
+        return center_scores, planar_scores
 
     @staticmethod
     def compute_depth_discontinuity_score(point_cloud, num_channels):
@@ -200,8 +201,9 @@ class PcEdgeDetector:
         Return:      A binary mask indicating edges in the point cloud."""
 
         # Calculate the polar angle for every point
-        polar_angle = 180 * np.arctan2(point_cloud[:, 2], np.sqrt(
-            np.square(point_cloud[:, 0]) + np.square(point_cloud[:, 1]))) / np.pi
+        polar_angle = 180 * np.arctan2(
+            point_cloud[:, 2], np.hypot(point_cloud[:, 0],
+                                        point_cloud[:, 1])) / np.pi
 
         # Calculate 64 cluster means
         max_polar_angle = np.max(polar_angle)
@@ -303,7 +305,7 @@ class PcEdgeDetector:
         y = pc[:, 1]
         z = pc[:, 2]
 
-        polar_angle = np.arctan2(np.sqrt(np.square(x) + np.square(y)), z)
+        polar_angle = np.arctan2(np.hypot(x, y), z)
 
         # Find the indices of the 360 / horizontal_resolution smallest/largest polar angles
         size_channel = 3 * int(360 / hor_res)
@@ -321,12 +323,11 @@ class PcEdgeDetector:
         """
         Return point indices of points outside radius
         """
-        distance = np.sqrt(
-            np.power(pc[:, 0], 2) +
-            np.power(pc[:, 1], 2) +
-            np.power(pc[:, 2], 2))
+        # Compare squared distances, no square root needed
+        xyz = pc[:, :3]
+        squared_distance = np.einsum('ij,ij->i', xyz, xyz)
 
-        return np.argwhere(distance > radius)
+        return np.argwhere(squared_distance > radius**2)
 
     def pc_visualize_edges(self, xyz, edge_idxs, edge_scores):
         v_min = np.min(edge_scores)
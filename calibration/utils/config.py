@@ -1,6 +1,11 @@
 import argparse
 import json
 
+# Defaults of the JSON arguments. Sequences are tuples so that no parsed
+# config can mutate the shared default, convert with list() if needed
+FRAMES_DEFAULT = -1
+SIG_IN_DEFAULT = (3.0, 2.0, 1.0)
+
 
 def command_line_parser():
     parser = argparse.ArgumentParser(
@@ -18,11 +23,11 @@ def command_line_parser():
         help='Path to directory containing point clouds, images and calibration')
 
     parser.add_argument(
-        '--frames', type=json.loads, default='-1',
-        help='Initial guess of the transformation')
+        '--frames', type=json.loads, default=FRAMES_DEFAULT,
+        help='JSON list of the frame indices to load, -1 loads all frames')
 
     parser.add_argument(
-        '--sig_in', type=json.loads, default='[3.0 ,2.0 ,1.0]',
+        '--sig_in', type=json.loads, default=SIG_IN_DEFAULT,
         help='Values for the refinement steps')
 
     # Point Cloud Edge Detection Parameters
@@ -32,7 +37,7 @@ def command_line_parser():
              'detection')
 
     parser.add_argument(
-        '--pc_ed_num_nn', type=float, default=75,
+        '--pc_ed_num_nn', type=int, default=75,
         help='Min number of nearest neighbors used')
 
     parser.add_argument(
@@ -1,7 +1,7 @@
 """Utility functions for working with the KITTI dataset"""
 import numpy as np
 from sklearn.metrics import mutual_info_score
-from pyquaternion import Quaternion
+from scipy.spatial.transform import Rotation
 import cv2
 import os
 import sys
@@ -122,6 +122,32 @@ def print_projection_plt(points, color, image):
     return cv2.cvtColor(hsv_image, cv2.COLOR_HSV2RGB)
 
 
+def silverman_bandwidths(hists):
+    """
+    Given histograms of integer levels, compute the bandwidth of a Gaussian
+    KDE fit to the samples of each with Silverman's rule, the way
+    KDEpy's bw='silverman' does it.
+
+    :param hists: (L, K) numpy array, counts of the levels 0..L-1 of
+                  K sets of samples
+    :return: (K, ) bandwidth of each histogram, 1 where the samples are
+             constant
+    """
+    levels = np.arange(hists.shape[0])[:, np.newaxis]
+    num_samples = np.sum(hists, axis=0)
+    mean = np.sum(hists * levels, axis=0) / num_samples
+    std = np.sqrt(np.sum(hists * np.square(levels - mean), axis=0) /
+                  np.maximum(num_samples - 1, 1))
+
+    cum_probs = np.cumsum(hists, axis=0) / num_samples
+    iqr = (np.argmax(cum_probs >= 0.75, axis=0) -
+           np.argmax(cum_probs >= 0.25, axis=0)) / 1.3489795003921634
+
+    sigma = np.minimum(std, iqr)
+    sigma = np.where(sigma > 0, sigma, std)
+    return np.where(sigma > 0, sigma * (num_samples * 0.75) ** -0.2, 1.0)
+
+
 def skew(vector):
     """
     this function returns a numpy array with the skew symmetric cross product matrix for vector.
@@ -141,9 +167,12 @@ def jacobian(omega):
     """Given rotation vector compute Jacobian (3x3). ith column represents derivative of camera frame
        position wrt rotation vector"""
 
+    omega = np.ravel(omega)
     omega_mag = np.linalg.norm(omega, 2)
-    a = (omega/omega_mag).reshape((3, 1))
-    jac = (np.sin(omega_mag)/omega_mag)*np.eye(3) + (1-np.sin(omega_mag)/omega_mag)*np.dot(a, a.T) + \
+    if omega_mag == 0:
+        return np.eye(3)
+    a = omega/omega_mag
+    jac = (np.sin(omega_mag)/omega_mag)*np.eye(3) + (1-np.sin(omega_mag)/omega_mag)*np.outer(a, a) + \
           ((1-np.cos(omega_mag))/omega_mag)*skew(a)
     return jac
 
@@ -181,9 +210,7 @@ def perturb_tau(tau_in, trans_range=0.05, angle_range=2.5):
 
     # Unpack tau
     trans_vec = deepcopy(tau_in[3:])
-    rot_vec = deepcopy(tau_in[:3])
-    angle = np.linalg.norm(rot_vec, 2)
-    axis = rot_vec/angle
+    rot_vec = np.asarray(tau_in[:3], dtype=np.float64)
 
     # Sample noise
     x_noise = np.random.uniform(-trans_range, trans_range)
@@ -194,13 +221,12 @@ def perturb_tau(tau_in, trans_range=0.05, angle_range=2.5):
     rot_z_noise = np.deg2rad(np.random.uniform(-angle_range, angle_range))
 
     # Add noise by sampling an added noisy rotation
-    R_noise = Quaternion(euler_to_quaternion(rot_x_noise, rot_y_noise, rot_z_noise)).rotation_matrix
-    R_old = Quaternion(axis=axis, angle=angle).rotation_matrix
+    R_noise = Rotation.from_euler(
+        'xyz', [rot_x_noise, rot_y_noise, rot_z_noise]).as_matrix()
+    R_old, _ = cv2.Rodrigues(rot_vec.reshape((3, 1)))
     R_new = np.dot(R_noise, R_old)
-    quat_new = Quaternion(matrix=R_new)
-    angle_new = quat_new.angle
-    axis_new = quat_new.axis
-    rot_vec_new = angle_new*axis_new
+    rot_vec_new, _ = cv2.Rodrigues(R_new)
+    rot_vec_new = rot_vec_new.reshape((3,))
 
     # Apply noise
     trans_vec_new = trans_vec + [x_noise, y_noise, z_noise]
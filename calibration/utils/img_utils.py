@@ -4,6 +4,8 @@ Module for Generating Point Cloud Projections
 used for Fusion Miscalibration Detection Network
 """
 
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
@@ -56,36 +58,135 @@ def plot_2d(values, figname=None):
     plt.close()
 
 
+@lru_cache(maxsize=32)
+def getGaussianKernel1D(sigma):
+    """Given sigma, get 1D kernel of dimensions (6*int(sigma)+1, 1). Kernels
+    are memoized per sigma and must not be modified in place."""
+    return cv2.getGaussianKernel(6*int(sigma)+1, sigma).astype(np.float32)
+
+
 def getGaussianKernel2D(sigma):
     """Given sigma, get 2D kernel of dimensions (6*int(sigma), 6*int(sigma))"""
-    gauss1d = cv2.getGaussianKernel(6*int(sigma)+1, sigma).astype(np.float32)
+    gauss1d = getGaussianKernel1D(sigma)
     gaussian = np.dot(gauss1d, gauss1d.T)
     return gaussian
 
 
+def getGaussianKernels1D(sigmas):
+    """Given (N, ) sigmas, get the 1D kernels of all sigmas at once as rows of
+    a (N, 6*int(max(sigmas))+1) float32 array. Kernel i has support
+    6*int(sigma_i)+1 around the center column and is normalized like
+    cv2.getGaussianKernel."""
+    radii = 3 * sigmas.astype(np.int64)
+    max_radius = radii.max() if radii.size else 0
+    offsets = np.arange(-max_radius, max_radius + 1)
+
+    kernels = np.exp(-np.square(offsets) / (2 * np.square(sigmas[:, None])))
+    kernels[np.abs(offsets) > radii[:, None]] = 0
+    kernels /= kernels.sum(axis=1, keepdims=True)
+    return kernels.astype(np.float32)
+
+
+def quantize_sigmas(sigmas, num_buckets=32):
+    """Quantize (N, ) sigmas into num_buckets bins evenly spaced over their
+    range, so that one kernel per bin can be shared by all sigmas in it.
+
+    Bins are also split where int(sigma) changes and each center lies in the
+    same integer interval as its sigmas, so a quantized sigma keeps the
+    3*int(sigma) window of the sigma it replaces. Return the (K, ) centers of
+    the K non-empty bins and the (N, ) bin of each sigma."""
+    sigma_min, sigma_max = np.min(sigmas), np.max(sigmas)
+    if sigma_max <= sigma_min:
+        return np.full(1, sigma_min), np.zeros(sigmas.shape[0], dtype=np.int64)
+
+    bin_width = (sigma_max - sigma_min) / num_buckets
+    even_bins = np.minimum(((sigmas - sigma_min) / bin_width).astype(np.int64),
+                           num_buckets - 1)
+    radii = sigmas.astype(np.int64)
+    bin_keys, bins = np.unique(radii * num_buckets + even_bins,
+                               return_inverse=True)
+    bin_radii, bin_idxs = np.divmod(bin_keys, num_buckets)
+
+    # Center of the part of each even bin inside [radius, radius + 1)
+    lower = np.maximum(sigma_min + bin_idxs * bin_width, bin_radii)
+    upper = np.minimum(sigma_min + (bin_idxs + 1) * bin_width, bin_radii + 1)
+    centers = np.minimum((lower + upper) / 2, np.nextafter(bin_radii + 1, 0))
+    return centers, bins.reshape(-1)
+
+
 def outside_image(image, pixel):
     """Check whether a given pixel location (x, y) is outside the given image"""
     return (pixel[0] < 0 or pixel[0] >= image.shape[0] or
             pixel[1] < 0 or pixel[1] >= image.shape[1])
 
 
+def draw_pixels(image, pixels, values, radius=0, per_pixel_values=True):
+    """
+    Draw filled dots at the given pixel locations with one batched
+    assignment per offset inside the dot, instead of one call per pixel.
+    Offsets that land outside the image are ignored.
+
+    param: image            : (H, W) or (H, W, C) image, drawn on in place
+    param: pixels           : (N, 2) pixel locations (x, y)
+    param: values           : (N, ) or (N, C) value of each dot, or a single
+                              value (scalar or (C, ) color)
+    param: radius           : radius of the dots in pixels, 0 draws single
+                              pixels
+    param: per_pixel_values : True if values holds one value per dot, False
+                              if all dots are drawn with the single value
+    return: image with the dots drawn
+    """
+    img_h, img_w = image.shape[:2]
+    pixels = pixels.astype(np.int64)
+
+    # Draw the center last so that each dot keeps its own value there
+    offsets = [(dx, dy)
+               for dy in range(-radius, radius + 1)
+               for dx in range(-radius, radius + 1)
+               if dx * dx + dy * dy <= radius * radius]
+    offsets.sort(key=lambda offset: -(offset[0]**2 + offset[1]**2))
+
+    for dx, dy in offsets:
+        xs = pixels[:, 0] + dx
+        ys = pixels[:, 1] + dy
+        inside = np.logical_and.reduce(
+            [xs >= 0, xs < img_w, ys >= 0, ys < img_h])
+        if per_pixel_values:
+            image[ys[inside], xs[inside]] = values[inside]
+        else:
+            image[ys[inside], xs[inside]] = values
+
+    return image
+
+
+# (256, 3) uint8 lookup table of the jet colormap
+JET_LUT = (plt.cm.jet(np.arange(256))[:, :3] * 255).astype(np.uint8)
+
+
+def jet_colors(score):
+    """
+    Map scores to (N, 3) uint8 jet colors through JET_LUT. Scores are
+    normalized to their own range first, like plt.Normalize() does.
+    """
+    score_min, score_max = np.min(score), np.max(score)
+    if score_max > score_min:
+        norm = (score - score_min) * (256.0 / (score_max - score_min))
+    else:
+        norm = np.zeros(score.shape)
+    return JET_LUT[np.minimum(norm.astype(np.int64), 255)]
+
+
 def scalar_to_color(pc, score=None, min_d=0, max_d=60):
     """
     print Color(HSV's H value) corresponding to score
     """
     if score is None:
-        score = np.sqrt(
-            np.power(pc[:, 0], 2) +
-            np.power(pc[:, 1], 2) +
-            np.power(pc[:, 2], 2))
+        score = np.linalg.norm(pc[:, :3], axis=1)
 
-    np.clip(score, 0, max_d, out=score)
+    score = np.clip(score, 0, max_d)
     # max distance is 120m but usually not usual
 
-    norm = plt.Normalize()
-    colors = plt.cm.jet(norm(score))
-
-    return (colors[:, :3] * 255).astype(np.uint8)
+    return jet_colors(score)
 
 
 def draw_point_matches(img_1, points_1, img_2, points_2):
@@ -104,17 +205,18 @@ def draw_point_matches(img_1, points_1, img_2, points_2):
     img_cat = np.concatenate([img_1, img_2], axis=1)
     img_cat = np.repeat(np.expand_dims(img_cat, axis=2), 3, axis=2)
 
+    # Draw the colors of all matches at once from a local generator
+    colors = np.random.default_rng().uniform(0.0, 255.0,
+                                             (points_1.shape[0], 3))
+
     for point_idx in range(points_1.shape[0]):
         pt_1 = points_1[point_idx, :]
         pt_2 = points_2[point_idx, :]
         pt_2[0] += w
 
-        color = (np.random.uniform()*255.0,
-                 np.random.uniform()*255.0,
-                 np.random.uniform()*255.0)
-        print(color)
         img_cat = cv2.line(
-            img_cat, tuple(pt_1.tolist()), tuple(pt_2.tolist()), color
+            img_cat, tuple(pt_1.tolist()), tuple(pt_2.tolist()),
+            tuple(colors[point_idx].tolist())
         )
 
     return img_cat
\ No newline at end of file
@@ -0,0 +1,254 @@
+"""JIT-compiled kernels for the hot loops of the calibration costs"""
+import numpy as np
+from numba import cuda, njit, prange
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def conv_cost_kernel(mu_x, mu_y, radii, kernel_idxs, kernels, pc_scores,
+                     img_edge_scores, edges_integral, cost_map):
+    """Compute the GMM cost of each projected lidar edge point and write it
+    into cost_map at the pixel the point lands on.
+
+    For each point, the image edge scores within the 3-sigma patch around
+    (mu_x, mu_y) are offset by the point's edge score, weighted with the
+    separable Gaussian kernel of the point and summed. The sum is normalized
+    by twice the number of edge pixels in the patch, which is looked up in
+    the integral image so that patches without edges are skipped.
+
+    :param mu_x: (N, ) integer pixel x-coordinates of the projected points.
+    :param mu_y: (N, ) integer pixel y-coordinates of the projected points.
+    :param radii: (N, ) integer patch radius of each point, 3*int(sigma).
+    :param kernel_idxs: (N, ) row of kernels used by each point.
+    :param kernels: (K, L) 1D Gaussian kernels centered at column L // 2.
+    :param pc_scores: (N, ) edge score of each lidar point.
+    :param img_edge_scores: (H, W) edge scores of the image.
+    :param edges_integral: (H+1, W+1) integral image of img_edge_scores != 0.
+    :param cost_map: (H, W) output map, written in place.
+    """
+    img_h, img_w = img_edge_scores.shape
+    center = kernels.shape[1] // 2
+    num_points = mu_x.shape[0]
+    point_costs = np.zeros(num_points)
+    has_edges = np.zeros(num_points, dtype=np.bool_)
+
+    for i in prange(num_points):
+        radius = radii[i]
+        x, y = mu_x[i], mu_y[i]
+        top = min(radius, y)
+        bot = min(radius + 1, img_h - y - 1)
+        left = min(radius, x)
+        right = min(radius + 1, img_w - x - 1)
+
+        num_edges = edges_integral[y + bot, x + right] - \
+            edges_integral[y - top, x + right] - \
+            edges_integral[y + bot, x - left] + \
+            edges_integral[y - top, x - left]
+        if num_edges == 0:
+            continue
+
+        # Everything but the image row is fixed per point, so only the row
+        # sum of the horizontal taps is accumulated per pixel
+        kernel = kernels[kernel_idxs[i]]
+        pc_score = pc_scores[i]
+        offset_u = center - x
+        cost = 0.0
+        for v in range(y - top, y + bot):
+            row = img_edge_scores[v]
+            row_cost = 0.0
+            for u in range(x - left, x + right):
+                score = row[u]
+                if score != 0:
+                    row_cost += (score + pc_score) * kernel[offset_u + u]
+            cost += kernel[center + v - y] * row_cost
+
+        point_costs[i] = cost / (2 * num_edges)
+        has_edges[i] = True
+
+    # Scatter sequentially, points landing on the same pixel overwrite it
+    for i in range(num_points):
+        if has_edges[i]:
+            cost_map[mu_y[i], mu_x[i]] = point_costs[i]
+
+
+@cuda.jit
+def conv_cost_kernel_cuda(mu_x, mu_y, radii, kernel_idxs, kernels, pc_scores,
+                          img_edge_scores, edges_integral, point_costs,
+                          has_edges):
+    """CUDA version of conv_cost_kernel with one thread per point. Writes the
+    cost of each point to point_costs and whether its patch has any edges
+    to has_edges, the scatter into the cost map is left to the host."""
+    i = cuda.grid(1)
+    if i >= mu_x.shape[0]:
+        return
+
+    img_h, img_w = img_edge_scores.shape
+    center = kernels.shape[1] // 2
+    radius = radii[i]
+    x, y = mu_x[i], mu_y[i]
+    top = min(radius, y)
+    bot = min(radius + 1, img_h - y - 1)
+    left = min(radius, x)
+    right = min(radius + 1, img_w - x - 1)
+
+    num_edges = edges_integral[y + bot, x + right] - \
+        edges_integral[y - top, x + right] - \
+        edges_integral[y + bot, x - left] + \
+        edges_integral[y - top, x - left]
+    has_edges[i] = num_edges != 0
+    if num_edges == 0:
+        return
+
+    k = kernel_idxs[i]
+    pc_score = pc_scores[i]
+    offset_u = center - x
+    cost = 0.0
+    for v in range(y - top, y + bot):
+        row_cost = 0.0
+        for u in range(x - left, x + right):
+            score = img_edge_scores[v, u]
+            if score != 0:
+                row_cost += (score + pc_score) * kernels[k, offset_u + u]
+        cost += kernels[k, center + v - y] * row_cost
+
+    point_costs[i] = cost / (2 * num_edges)
+
+
+def conv_cost_cuda(mu_x, mu_y, radii, kernel_idxs, kernels, pc_scores,
+                   img_edge_scores, edges_integral, cost_map,
+                   threads_per_block=128):
+    """Compute the GMM cost map like conv_cost_kernel on the GPU.
+
+    The per-point inputs are copied to the device on every call. The edge
+    scores and their integral image are expected to be device arrays already
+    (CuPy or Numba), since they do not change during optimization.
+
+    :param img_edge_scores: (H, W) edge scores of the image on the device.
+    :param edges_integral: (H+1, W+1) integral image of img_edge_scores != 0
+                           on the device.
+    :param cost_map: (H, W) host output map, written in place.
+    :param threads_per_block: CUDA block size of the launch.
+    """
+    num_points = mu_x.shape[0]
+    if num_points == 0:
+        return
+
+    point_costs = cuda.device_array(num_points, dtype=np.float64)
+    has_edges = cuda.device_array(num_points, dtype=np.bool_)
+    num_blocks = (num_points + threads_per_block - 1) // threads_per_block
+    conv_cost_kernel_cuda[num_blocks, threads_per_block](
+        cuda.to_device(mu_x), cuda.to_device(mu_y), cuda.to_device(radii),
+        cuda.to_device(kernel_idxs), cuda.to_device(kernels),
+        cuda.to_device(pc_scores), img_edge_scores, edges_integral,
+        point_costs, has_edges)
+
+    # Scatter in point order, points landing on the same pixel overwrite it
+    has_edges = has_edges.copy_to_host()
+    cost_map[mu_y[has_edges], mu_x[has_edges]] = \
+        point_costs.copy_to_host()[has_edges]
+
+
+@njit(fastmath=True, cache=True)
+def sym3x3_eigvals(s00, s01, s02, s11, s12, s22):
+    """Closed-form eigenvalues of a symmetric 3x3 matrix (Smith 1961),
+    returned in decreasing order."""
+    q = (s00 + s11 + s22) / 3
+    p1 = s01 * s01 + s02 * s02 + s12 * s12
+    if p1 == 0:
+        e0, e1, e2 = s00, s11, s22
+        if e0 < e1:
+            e0, e1 = e1, e0
+        if e1 < e2:
+            e1, e2 = e2, e1
+        if e0 < e1:
+            e0, e1 = e1, e0
+        return e0, e1, e2
+
+    p2 = (s00 - q)**2 + (s11 - q)**2 + (s22 - q)**2 + 2 * p1
+    p = np.sqrt(p2 / 6)
+    b00, b11, b22 = (s00 - q) / p, (s11 - q) / p, (s22 - q) / p
+    b01, b02, b12 = s01 / p, s02 / p, s12 / p
+    r = (b00 * (b11 * b22 - b12 * b12) - b01 * (b01 * b22 - b12 * b02) +
+         b02 * (b01 * b12 - b11 * b02)) / 2
+    r = min(max(r, -1.0), 1.0)
+    phi = np.arccos(r) / 3
+
+    e0 = q + 2 * p * np.cos(phi)
+    e2 = q + 2 * p * np.cos(phi + 2 * np.pi / 3)
+    e1 = 3 * q - e0 - e2
+    return e0, e1, e2
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def neighborhood_scores_kernel(pc, neighbor_idxs, max_neighbor_d, extra_ptrs,
+                               extra_idxs, center_scores, planar_scores):
+    """Compute the center and planarity scores of all points in one pass over
+    each neighborhood.
+
+    The neighborhood of point i is its row of neighbor_idxs plus the extra
+    neighbors extra_idxs[extra_ptrs[i]:extra_ptrs[i + 1]]. The center score
+    is the distance of the point to the neighborhood centroid scaled by the
+    largest neighbor distance (Kang 2019). The planarity score is computed
+    from the eigenvalues of the structure tensor of the neighborhood and the
+    point (Xia & Wang 2017).
+
+    :param pc: (N, 3) float64 pointcloud.
+    :param neighbor_idxs: (N, K) indices of the nearest neighbors.
+    :param max_neighbor_d: (N, ) distance to the farthest nearest neighbor.
+    :param extra_ptrs: (N+1, ) offsets of each point's extra neighbors.
+    :param extra_idxs: (E, ) indices of the extra neighbors.
+    :param center_scores: (N, ) output, written in place.
+    :param planar_scores: (N, ) output, written in place.
+    """
+    num_points, num_nn = neighbor_idxs.shape
+
+    for i in prange(num_points):
+        x, y, z = pc[i, 0], pc[i, 1], pc[i, 2]
+        first_extra, last_extra = extra_ptrs[i], extra_ptrs[i + 1]
+        num_neighbors = num_nn + last_extra - first_extra
+
+        # Centroid of the neighborhood, and the largest neighbor distance
+        sum_x, sum_y, sum_z = 0.0, 0.0, 0.0
+        max_d = max_neighbor_d[i]
+        for k in range(num_neighbors):
+            if k < num_nn:
+                j = neighbor_idxs[i, k]
+            else:
+                j = extra_idxs[first_extra + k - num_nn]
+                max_d = max(max_d, np.sqrt((pc[j, 0] - x)**2 +
+                                           (pc[j, 1] - y)**2 +
+                                           (pc[j, 2] - z)**2))
+            sum_x += pc[j, 0]
+            sum_y += pc[j, 1]
+            sum_z += pc[j, 2]
+
+        center_scores[i] = np.sqrt(
+            (x - sum_x / num_neighbors)**2 + (y - sum_y / num_neighbors)**2 +
+            (z - sum_z / num_neighbors)**2) / max_d
+
+        # Structure tensor of the neighborhood including the point itself
+        num_complete = num_neighbors + 1
+        mean_x = (sum_x + x) / num_complete
+        mean_y = (sum_y + y) / num_complete
+        mean_z = (sum_z + z) / num_complete
+        dx, dy, dz = x - mean_x, y - mean_y, z - mean_z
+        s00, s01, s02 = dx * dx, dx * dy, dx * dz
+        s11, s12, s22 = dy * dy, dy * dz, dz * dz
+        for k in range(num_neighbors):
+            if k < num_nn:
+                j = neighbor_idxs[i, k]
+            else:
+                j = extra_idxs[first_extra + k - num_nn]
+            dx = pc[j, 0] - mean_x
+            dy = pc[j, 1] - mean_y
+            dz = pc[j, 2] - mean_z
+            s00 += dx * dx
+            s01 += dx * dy
+            s02 += dx * dz
+            s11 += dy * dy
+            s12 += dy * dz
+            s22 += dz * dz
+
+        e0, e1, e2 = sym3x3_eigvals(s00 / num_complete, s01 / num_complete,
+                                    s02 / num_complete, s11 / num_complete,
+                                    s12 / num_complete, s22 / num_complete)
+        planar_scores[i] = 1 - (e1 - e2) / e0
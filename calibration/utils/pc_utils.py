@@ -2,7 +2,6 @@
 import numpy as np
 import open3d as o3d
 from scipy.spatial import ckdtree
-from scipy.interpolate import griddata
 import matplotlib
 from matplotlib import pyplot as plt
 from matplotlib import cm as cm
@@ -26,7 +25,7 @@ def get_first_and_last_channel_idxs(pc, hor_res=0.2):
     x = pc[:, 0]
     y = pc[:, 1]
     z = pc[:, 2]
-    polar_angle = np.arctan2(np.sqrt(np.square(x) + np.square(y)), z)
+    polar_angle = np.arctan2(np.hypot(x, y), z)
 
     # Find the indices of the 360 / horizontal_resolution smallest/largest polar angles
     size_channel = 2 * int(360 / hor_res)
@@ -170,32 +169,69 @@ def custom_draw_geometry_with_key_callbacks(pcd):
         [pcd], key_to_callback)
 
 
-def get_pc_pixels(pc, R, T, K, img_dims):
-    R = R.reshape((3, 3))
-    T = T.reshape((3, 1))
-    K = K.reshape((3, 3))
+def project_pc(pc, R, T, K, img_dims):
+    """Project an (N, 3) pointcloud onto an image of dimensions (h, w) with
+    extrinsics R (3, 3), T (3, 1) and camera intrinsics K (3, 3).
+
+    K is folded into the extrinsics first, so the points are projected with a
+    single (N, 3) x (3, 3) product instead of transforming them to the camera
+    frame in between.
+
+    Return the projected pixels (N, 2) and a mask (N, ) of the pixels that
+    land within the image bounds.
+    """
+    KR = np.dot(K.reshape((3, 3)), R.reshape((3, 3)))
+    KT = np.dot(K.reshape((3, 3)), T.reshape((3, 1)))
+
+    pc_pixels = np.dot(pc, KR.T) + KT.T
+    pc_pixels = pc_pixels[:, :2] / pc_pixels[:, 2:3]
+
+    """Remove pixels outside image bounds"""
+    pixels_x, pixels_y = pc_pixels[:, 0], pc_pixels[:, 1]
+    inside_mask = pixels_x >= 0
+    inside_mask &= pixels_x <= img_dims[1]
+    inside_mask &= pixels_y >= 0
+    inside_mask &= pixels_y <= img_dims[0]
+    return pc_pixels, inside_mask
+
 
+def get_pc_pixels(pc, R, T, K, img_dims):
     """Remove points behind the vehicle"""
     pc = pc[pc[:, 0] > 0, :]
 
-    """Separate position from reflectance"""
-    refl = pc[:, 3]
-    pc = pc[:, :3]
-
     """Transform from LiDAR to camera frame, project onto image"""
-    pc_cam = np.matmul(R, np.transpose(pc)) + T
-    pc_pixels = np.matmul(K, pc_cam)
-    pc_pixels /= pc_pixels[2, :]
-    pc_pixels = np.transpose(pc_pixels[:2, :])  # Reshape to Nx2
+    pc_pixels, valid_mask = project_pc(pc[:, :3], R, T, K, img_dims)
+    return pc_pixels[valid_mask, :]
 
-    """Remove pixels outside image bounds"""
-    x_mask = np.logical_and(pc_pixels[:, 0] >= 0,
-                            pc_pixels[:, 0] <= img_dims[1])
-    y_mask = np.logical_and(pc_pixels[:, 1] >= 0,
-                            pc_pixels[:, 1] <= img_dims[0])
-    valid_idxs = np.squeeze(np.argwhere(np.logical_and(x_mask, y_mask)))
-    pc_pixels = pc_pixels[valid_idxs, :]
-    return pc_pixels
+
+def fill_pixel_windows(img, pc_pixels, values, fill_rad=3):
+    """Fill a (2*fill_rad, 2*fill_rad) window around each of the projected
+    pixels (N, 2) of img with the pixel's value (N, ), clipped to the image.
+
+    All windows are filled in one vectorized pass. Where windows overlap, the
+    point that comes later wins, as if the windows were painted one at a time.
+    """
+    img_h, img_w = img.shape[:2]
+    offsets = np.arange(-fill_rad, fill_rad)
+    xs = pc_pixels[:, 0].astype(np.int64)
+    ys = pc_pixels[:, 1].astype(np.int64)
+
+    # (N, 2*fill_rad, 2*fill_rad) mask and linear indices of window pixels
+    win_xs = xs[:, np.newaxis] + offsets
+    win_ys = ys[:, np.newaxis] + offsets
+    inside = np.logical_and(win_ys >= 0, win_ys < img_h)[:, :, np.newaxis] & \
+        np.logical_and(win_xs >= 0, win_xs < img_w)[:, np.newaxis, :]
+    win_idxs = (ys * img_w + xs)[:, np.newaxis, np.newaxis] + \
+        (offsets[:, np.newaxis] * img_w + offsets[np.newaxis, :])
+    point_idxs, _, _ = np.nonzero(inside)
+
+    owner = np.full(img_h * img_w, -1, dtype=np.int64)
+    np.maximum.at(owner, win_idxs[inside], point_idxs)
+    owner = owner.reshape((img_h, img_w))
+
+    filled = owner >= 0
+    img[filled] = values[owner[filled]]
+    return img
 
 
 def gen_reflectance_image(pc, R, T, K, img_dims, fill=False, fill_rad=3):
@@ -208,10 +244,6 @@ def gen_reflectance_image(pc, R, T, K, img_dims, fill=False, fill_rad=3):
      areas with pixels.
      """
 
-    R = R.reshape((3, 3))
-    T = T.reshape((3, 1))
-    K = K.reshape((3, 3))
-
     """Remove points behind the vehicle"""
     pc = pc[pc[:, 0] > 0, :]
 
@@ -220,29 +252,16 @@ def gen_reflectance_image(pc, R, T, K, img_dims, fill=False, fill_rad=3):
     pc = pc[:, :3]
 
     """Transform from LiDAR to camera frame, project onto image"""
-    pc_cam = np.matmul(R, np.transpose(pc)) + T
-    pc_pixels = np.matmul(K, pc_cam)
-    pc_pixels /= pc_pixels[2, :]
-    pc_pixels = np.transpose(pc_pixels[:2, :]) # Reshape to Nx2
-
-    """Remove pixels outside image bounds"""
-    x_mask = np.logical_and(pc_pixels[:, 0] >= 0,
-                            pc_pixels[:, 0] <= img_dims[1])
-    y_mask = np.logical_and(pc_pixels[:, 1] >= 0,
-                            pc_pixels[:, 1] <= img_dims[0])
-    valid_idxs = np.squeeze(np.argwhere(np.logical_and(x_mask, y_mask)))
-    pc_pixels = pc_pixels[valid_idxs, :]
-    refl = refl[valid_idxs]
+    pc_pixels, valid_mask = project_pc(pc, R, T, K, img_dims)
+    pc_pixels = pc_pixels[valid_mask, :]
+    refl = refl[valid_mask]
 
     """Generate image and color with reflectance"""
     refl *= 255
     refl_img = np.zeros(img_dims, dtype=np.uint8)
     mask_img = np.zeros(img_dims, dtype=np.uint8)
 
-    for i in range(pc_pixels.shape[0]):
-        x, y = pc_pixels[i, :]
-        x, y = int(x), int(y)
-        refl_img[y-fill_rad:y+fill_rad, x-fill_rad:x+fill_rad] = refl[i]
+    fill_pixel_windows(refl_img, pc_pixels, refl, fill_rad)
 
     x_min, x_max = int(np.min(pc_pixels[:, 0])), int(np.max(pc_pixels[:, 0]))
     y_min, y_max = int(np.min(pc_pixels[:, 1])), int(np.max(pc_pixels[:, 1]))
@@ -251,6 +270,40 @@ def gen_reflectance_image(pc, R, T, K, img_dims, fill=False, fill_rad=3):
     return refl_img, mask_img
 
 
+def gen_dense_depth_image(pc_pixels, depth, img_dims):
+    """Given projected pixels (N, 2) and their depths (N, ), generate a depth
+    image with specified image dimensions (h, w).
+
+    Depths are scattered into the image keeping the closest point per pixel
+    (z-buffer). Pixels holding a point are left as measured. Empty pixels
+    inside the convex hull of the points take the depth of the nearest
+    measured pixel, found with one distance transform, which is O(N + h*w)
+    instead of interpolating over a Delaunay triangulation. Pixels outside
+    the hull are NaN, as with griddata.
+    """
+    img_h, img_w = img_dims
+    xs = np.minimum(pc_pixels[:, 0].astype(np.int64), img_w - 1)
+    ys = np.minimum(pc_pixels[:, 1].astype(np.int64), img_h - 1)
+
+    depth_img = np.full((img_h, img_w), np.inf, dtype=np.float32)
+    np.minimum.at(depth_img, (ys, xs), depth)
+    empty = np.isinf(depth_img)
+
+    hull = cv.convexHull(pc_pixels.astype(np.float32))
+    hull_mask = np.zeros((img_h, img_w), dtype=np.uint8)
+    cv.fillConvexPoly(hull_mask, np.round(hull).astype(np.int32), 1)
+    holes = empty & hull_mask.astype(bool)
+
+    # Labels number the measured pixels in row-major order, starting at 1
+    _, labels = cv.distanceTransformWithLabels(
+        empty.astype(np.uint8), cv.DIST_L2, 5,
+        labelType=cv.DIST_LABEL_PIXEL)
+    measured = np.flatnonzero(~empty)
+    depth_img[holes] = depth_img.ravel()[measured[labels[holes] - 1]]
+    depth_img[empty & ~holes] = np.nan
+    return depth_img
+
+
 def gen_depth_image(pc, R, T, K, img_dims, fill_rad=3):
     """Given a pointcloud, rotation matrix, translation vector, and camera
      intrinsics, generate the reflectance image with specified image dimensions.
@@ -261,10 +314,6 @@ def gen_depth_image(pc, R, T, K, img_dims, fill_rad=3):
      areas with pixels.
      """
 
-    R = R.reshape((3, 3))
-    T = T.reshape((3, 1))
-    K = K.reshape((3, 3))
-
     """Remove points behind the vehicle"""
     pc = pc[pc[:, 0] > 0, :]
     pc = pc[pc[:, 0] < 30, :]
@@ -273,28 +322,12 @@ def gen_depth_image(pc, R, T, K, img_dims, fill_rad=3):
     pc = pc[:, :3]
 
     """Transform from LiDAR to camera frame, project onto image"""
-    pc_cam = np.matmul(R, np.transpose(pc)) + T
-    pc_pixels = np.matmul(K, pc_cam)
-    pc_pixels /= pc_pixels[2, :]
-    pc_pixels = np.transpose(pc_pixels[:2, :]) # Reshape to Nx2
-    pc_cam = pc_cam.T
+    pc_pixels, valid_mask = project_pc(pc, R, T, K, img_dims)
+    pc_pixels = pc_pixels[valid_mask, :]
 
-    """Remove pixels outside image bounds"""
-    x_mask = np.logical_and(pc_pixels[:, 0] >= 0,
-                            pc_pixels[:, 0] <= img_dims[1])
-    y_mask = np.logical_and(pc_pixels[:, 1] >= 0,
-                            pc_pixels[:, 1] <= img_dims[0])
-    valid_idxs = np.squeeze(np.argwhere(np.logical_and(x_mask, y_mask)))
-    pc_pixels = pc_pixels[valid_idxs, :]
-
-    img_h, img_w = img_dims
-    grid_x, grid_y = np.mgrid[0:img_w, 0:img_h]
-
-    depth = np.linalg.norm(pc_cam, ord=2, axis=1)
-    depth_valid = depth[valid_idxs]
-    depth_img = griddata(pc_pixels,
-                         depth_valid, (grid_x, grid_y),
-                         method='linear').T
+    pc_cam = np.dot(pc[valid_mask], R.reshape((3, 3)).T) + T.reshape((1, 3))
+    depth_valid = np.linalg.norm(pc_cam, ord=2, axis=1)
+    depth_img = gen_dense_depth_image(pc_pixels, depth_valid, img_dims)
 
     depth_img = (depth_img * 255 / np.nanmax(depth_img)).astype(np.uint8)
 
@@ -316,10 +349,6 @@ def gen_synthetic_image(pc, refl, R, T, K, img_dims, fill_rad=3,
      areas with pixels.
      """
 
-    R = R.reshape((3, 3))
-    T = T.reshape((3, 1))
-    K = K.reshape((3, 3))
-
     """Remove points behind the vehicle"""
     pc_mask = np.logical_and(pc[:, 0] > 0, pc[:, 0] < 30)
     pc = pc[pc_mask, :]
@@ -329,39 +358,20 @@ def gen_synthetic_image(pc, refl, R, T, K, img_dims, fill_rad=3,
     pc = pc[:, :3]
 
     """Transform from LiDAR to camera frame, project onto image"""
-    pc_cam = np.matmul(R, np.transpose(pc)) + T
-    pc_pixels = np.matmul(K, pc_cam)
-    pc_pixels /= pc_pixels[2, :]
-    pc_pixels = np.transpose(pc_pixels[:2, :]) # Reshape to Nx2
-    pc_cam = pc_cam.T
-
-    """Remove pixels outside image bounds"""
-    x_mask = np.logical_and(pc_pixels[:, 0] >= 0,
-                            pc_pixels[:, 0] <= img_dims[1])
-    y_mask = np.logical_and(pc_pixels[:, 1] >= 0,
-                            pc_pixels[:, 1] <= img_dims[0])
-    valid_idxs = np.squeeze(np.argwhere(np.logical_and(x_mask, y_mask)))
-    pc_pixels = pc_pixels[valid_idxs, :]
-    refl = refl[valid_idxs]
-
-    img_h, img_w = img_dims
-    grid_x, grid_y = np.mgrid[0:img_w, 0:img_h]
+    pc_pixels, valid_mask = project_pc(pc, R, T, K, img_dims)
+    pc_pixels = pc_pixels[valid_mask, :]
+    refl = refl[valid_mask]
 
     """Depth Image"""
-    depth = np.linalg.norm(pc_cam, ord=2, axis=1)
-    depth_valid = depth[valid_idxs]
-    depth_img = griddata(pc_pixels,
-                         depth_valid, (grid_x, grid_y),
-                         method='linear').T
+    pc_cam = np.dot(pc[valid_mask], R.reshape((3, 3)).T) + T.reshape((1, 3))
+    depth_valid = np.linalg.norm(pc_cam, ord=2, axis=1)
+    depth_img = gen_dense_depth_image(pc_pixels, depth_valid, img_dims)
     depth_img = (1 - depth_img * 255 / np.nanmax(depth_img)).astype(np.uint8)
 
     """Reflectance Image"""
     refl *= 255
     refl_img = np.zeros(img_dims, dtype=np.uint8)
-    for i in range(pc_pixels.shape[0]):
-        x, y = pc_pixels[i, :]
-        x, y = int(x), int(y)
-        refl_img[y - fill_rad:y + fill_rad, x - fill_rad:x + fill_rad] = refl[i]
+    fill_pixel_windows(refl_img, pc_pixels, refl, fill_rad)
     refl_img = cv.blur(refl_img, (3, 3))
 
     """Blend Image"""
@@ -0,0 +1,56 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from calibration.utils.img_utils import getGaussianKernels1D, quantize_sigmas
+from calibration.utils.kernel_utils import conv_cost_kernel
+
+
+def gmm_cost(sigmas, kernel_idxs, kernels, mu, pc_scores, img_edge_scores):
+    """Total GMM cost computed the way CameraLidarCalibrator.compute_conv_cost
+    does, with the window radius taken from the sigma each point uses."""
+    cost_map = np.zeros(img_edge_scores.shape)
+    conv_cost_kernel(np.ascontiguousarray(mu[:, 0]),
+                     np.ascontiguousarray(mu[:, 1]),
+                     3 * sigmas.astype(np.int64), kernel_idxs,
+                     np.ascontiguousarray(kernels), pc_scores,
+                     img_edge_scores,
+                     cv.integral((img_edge_scores != 0).astype(np.uint8)),
+                     cost_map)
+    return -np.sum(cost_map)
+
+
+@pytest.fixture
+def scene():
+    rng = np.random.default_rng(0)
+    img_h, img_w = 120, 160
+    img_edge_scores = np.where(rng.random((img_h, img_w)) < 0.2,
+                               rng.random((img_h, img_w)), 0)
+    img_edge_scores = img_edge_scores.astype(np.float32)
+    num_points = 2000
+    mu = np.column_stack((rng.integers(0, img_w, num_points),
+                          rng.integers(0, img_h, num_points)))
+    pc_scores = rng.random(num_points)
+    # Spans several int(sigma) boundaries, as sigma_in / distance does
+    sigmas = rng.uniform(0.5, 6.5, num_points)
+    return sigmas, mu, pc_scores, img_edge_scores
+
+
+def test_quantized_sigmas_keep_their_window(scene):
+    sigmas = scene[0]
+    centers, bins = quantize_sigmas(sigmas, 8)
+    assert np.array_equal(centers[bins].astype(np.int64),
+                          sigmas.astype(np.int64))
+
+
+@pytest.mark.parametrize('num_buckets', [8, 32])
+def test_quantized_cost_matches_exact(scene, num_buckets):
+    sigmas, mu, pc_scores, img_edge_scores = scene
+    exact = gmm_cost(sigmas, np.arange(sigmas.shape[0]),
+                     getGaussianKernels1D(sigmas), mu, pc_scores,
+                     img_edge_scores)
+
+    centers, bins = quantize_sigmas(sigmas, num_buckets)
+    quantized = gmm_cost(centers[bins], bins, getGaussianKernels1D(centers),
+                         mu, pc_scores, img_edge_scores)
+    assert abs(quantized - exact) <= 0.02 * abs(exact)
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from calibration.camera_lidar_calibrator import CameraLidarCalibrator
+
+
+@pytest.fixture
+def calibrator():
+    """Calibrator holding only what the correspondence costs use: the
+    intrinsics, the image size and two frames of 2D-3D matches."""
+    rng = np.random.default_rng(0)
+    calibrator = CameraLidarCalibrator.__new__(CameraLidarCalibrator)
+    calibrator.K = np.array([[700., 0., 640.],
+                             [0., 700., 360.],
+                             [0., 0., 1.]])
+    calibrator.img_detector = SimpleNamespace(img_w=1280, img_h=720)
+
+    tau_true = np.array([0.05, -0.1, 0.02, 0.3, -0.2, 0.1])
+    R, T = calibrator.tau_to_transform(tau_true)
+    calibrator.correspondences = []
+    for _ in range(2):
+        lidar_points = rng.uniform([-5, -3, 5], [5, 3, 20], (20, 3))
+        pixels_homo = np.dot(np.dot(lidar_points, R.T) + T.T, calibrator.K.T)
+        gray_pixels = pixels_homo[:, :2] / pixels_homo[:, 2:] + \
+            rng.normal(0, 2, (20, 2))
+        calibrator.correspondences.append((gray_pixels, lidar_points))
+
+    calibrator.update_extrinsics(tau_true + rng.normal(0, 0.02, 6))
+    return calibrator
+
+
+def test_residuals_match_corresp_cost(calibrator):
+    residuals = calibrator.compute_corresp_residuals(calibrator.tau)
+    assert np.allclose(residuals[0], calibrator.compute_corresp_cost()[1])
+
+
+def test_residuals_batch_matches_single_taus(calibrator):
+    taus = calibrator.tau + np.random.default_rng(1).normal(0, 0.01, (4, 6))
+    residuals = calibrator.compute_corresp_residuals(taus)
+    for tau, tau_residuals in zip(taus, residuals):
+        assert np.allclose(tau_residuals,
+                           calibrator.compute_corresp_residuals(tau)[0])
+
+
+def test_analytic_jacobian_matches_forward_differences(calibrator):
+    tau = calibrator.tau
+    steps = np.sqrt(np.finfo(np.float64).eps) * np.maximum(1, np.abs(tau))
+    taus = np.vstack((tau, tau + np.diag(steps)))
+    residuals = calibrator.compute_corresp_residuals(taus)
+    jac_fd = ((residuals[1:] - residuals[0]) / steps[:, np.newaxis]).T
+
+    jac = calibrator.compute_corresp_jacobian(tau)
+    assert jac.shape == jac_fd.shape
+    assert np.allclose(jac, jac_fd, atol=1e-3 * np.abs(jac_fd).max())
@@ -0,0 +1,24 @@
+import numpy as np
+
+from calibration.utils.img_utils import draw_pixels
+
+
+def test_single_color_with_as_many_dots_as_channels():
+    image = np.zeros((10, 10, 3), dtype=np.uint8)
+    pixels = np.array([[1, 1], [4, 4], [7, 7]])
+    draw_pixels(image, pixels, np.array([10, 20, 30], dtype=np.uint8),
+                per_pixel_values=False)
+
+    for x, y in pixels:
+        assert np.array_equal(image[y, x], [10, 20, 30])
+
+
+def test_per_pixel_values_with_radius():
+    image = np.zeros((10, 10), dtype=np.float32)
+    pixels = np.array([[2, 2], [3, 2], [-1, 5]])
+    draw_pixels(image, pixels, np.array([1., 2., 3.]), radius=1)
+
+    # Each dot keeps its own value at its center, the one outside the
+    # image only draws the part that lands inside
+    assert image[2, 2] == 1 and image[2, 3] == 2
+    assert image[5, 0] == 3 and np.count_nonzero(image == 3) == 1
@@ -0,0 +1,24 @@
+import numpy as np
+
+from calibration.camera_lidar_calibrator import CameraLidarCalibrator
+
+
+def test_tau_batch_to_transforms_matches_tau_to_transform():
+    rng = np.random.default_rng(0)
+    taus = np.column_stack((rng.uniform(-np.pi / 2, np.pi / 2, (16, 3)),
+                            rng.uniform(-5, 5, (16, 3))))
+    Rs, Ts = CameraLidarCalibrator.tau_batch_to_transforms(taus)
+
+    assert Rs.shape == (16, 3, 3) and Ts.shape == (16, 3)
+    for tau, R_batch, T_batch in zip(taus, Rs, Ts):
+        R, T = CameraLidarCalibrator.tau_to_transform(tau)
+        assert np.allclose(R_batch, R)
+        assert np.allclose(T_batch, T.ravel())
+
+
+def test_tau_batch_to_transforms_accepts_single_tau():
+    tau = np.array([0.1, -0.2, 0.3, 1.0, 2.0, 3.0])
+    Rs, Ts = CameraLidarCalibrator.tau_batch_to_transforms(tau)
+
+    R, T = CameraLidarCalibrator.tau_to_transform(tau)
+    assert np.allclose(Rs[0], R) and np.allclose(Ts[0], T.ravel())